@@ -0,0 +1,265 @@
+###
+# Copyright (c) 2009, Morten Lied Johansen
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Micro-benchmarks for the NetGamers message handlers.
+
+Drives __call__, doNotice, doMode, do366 and outFilter with synthetic message
+streams against FakeIrc, for a number of network/channel/notice-mix
+scenarios, and reports messages per second and per-message latency
+percentiles.  Run it from the plugin's directory:
+
+    python benchmark.py              # Compare with the stored baseline.
+    python benchmark.py --save       # Store the results as the new baseline.
+
+A scenario running more than --threshold slower than its baseline is a
+regression, and makes the script exit with status 1.
+"""
+
+import os
+import sys
+import json
+import random
+import optparse
+from timeit import default_timer as timer
+
+import supybot.conf as conf
+import supybot.ircmsgs as ircmsgs
+
+import plugin
+from fakeirc import FakeIrc
+
+BOT = 'P!cservice@netgamers.org'
+NICK = 'Bot'
+
+baselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'benchmark-baseline.json')
+
+# Notices from the Bot, and how often each one shows up in a mix.
+notices = {
+    'quiet': [('Password accepted - you are now recognized.', 1),
+              ('You are already opped on \x02#chan\x02.', 20)],
+    'services': [('Password accepted - you are now recognized.', 1),
+                 ('You have insufficient access to \x02#chan\x02.', 10),
+                 ('Access level 100 is required for that command.', 10),
+                 ('Inviting you to \x02#chan\x02.', 5),
+                 ('You have been unbanned from \x02#chan\x02.', 5),
+                 ('Something P has never said before.', 5)],
+}
+
+# (networks, channels, notice mix)
+scenarios = [(1, 10, 'quiet'), (1, 1000, 'quiet'), (1, 1000, 'services'),
+             (10, 100, 'services')]
+
+handlers = ['__call__', 'doNotice', 'doMode', 'do366', 'outFilter']
+
+settings = {'reggedNick': NICK, 'password': 'secret',
+            'botNick': 'P@cservice.netgamers.org', 'useRegged': True}
+
+def configure():
+    """Sets the registry values the benchmark relies on, and returns a
+    function that puts the old ones back."""
+    group = conf.supybot.plugins.NetGamers
+    old = dict([(name, group.get(name)()) for name in settings])
+    for (name, value) in settings.iteritems():
+        group.get(name).setValue(value)
+    def restore():
+        for (name, value) in old.iteritems():
+            group.get(name).setValue(value)
+    return restore
+
+def connect(cb, networks, channels):
+    """Returns FakeIrcs for networks networks with channels channels each,
+    already identified with the Bot."""
+    ircs = []
+    for i in range(networks):
+        irc = FakeIrc(network='NetGamers%s' % i, nick=NICK)
+        conf.registerNetwork(irc.network) # For the channels to JOIN.
+        irc.state.supported['NETWORK'] = 'NetGamers'
+        for j in range(channels):
+            irc.addChannel('#chan%s' % j, ['@%s' % BOT.split('!')[0],
+                                           'user%s' % j])
+        cb(irc, ircmsgs.IrcMsg(prefix='server', command='001', args=(NICK,)))
+        cb(irc, ircmsgs.notice(NICK, notices['quiet'][0][0], prefix=BOT))
+        irc.takeSent()
+        ircs.append(irc)
+    return ircs
+
+def stream(ircs, channels, mix, n):
+    """Yields n (irc, handler, msg) triples of synthetic traffic."""
+    rng = random.Random(n)
+    texts = []
+    for (text, weight) in notices[mix]:
+        texts.extend([text] * weight)
+    for i in xrange(n):
+        irc = ircs[i % len(ircs)]
+        channel = '#chan%s' % rng.randrange(channels)
+        user = 'user%s!u@h%s' % (i % 500, i % 500)
+        kind = rng.random()
+        if kind < 0.80:
+            msg = ircmsgs.privmsg(channel, 'Just chatting away.', prefix=user)
+            yield (irc, '__call__', msg)
+        elif kind < 0.85:
+            msg = ircmsgs.IrcMsg(prefix='server', command='PING',
+                                 args=('server',))
+            yield (irc, '__call__', msg)
+        elif kind < 0.90:
+            msg = ircmsgs.join(channel, prefix=user)
+            yield (irc, '__call__', msg)
+        elif kind < 0.94:
+            text = rng.choice(texts).replace('#chan', channel)
+            yield (irc, 'doNotice', ircmsgs.notice(NICK, text, prefix=BOT))
+        elif kind < 0.97:
+            target = rng.choice([NICK, user.split('!')[0]])
+            mode = rng.choice(['+o', '+v', '-o', '+h'])
+            msg = ircmsgs.IrcMsg(prefix=BOT, command='MODE',
+                                 args=(channel, mode, target))
+            yield (irc, 'doMode', msg)
+        elif kind < 0.98:
+            msg = ircmsgs.IrcMsg(prefix='server', command='366',
+                                 args=(NICK, channel, 'End of /NAMES list.'))
+            yield (irc, 'do366', msg)
+        else:
+            out = rng.choice([ircmsgs.join(channel),
+                              ircmsgs.privmsg(channel, 'Hello.')])
+            yield (irc, 'outFilter', out)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(n=20000, scenarios=scenarios):
+    """Runs the scenarios with n messages each.
+
+    Returns a dict mapping scenario names to dicts of handler names to
+    (messages, msgs/sec, p50, p90, p99) tuples, latencies in microseconds.
+    """
+    restore = configure()
+    results = {}
+    try:
+        for (networks, channels, mix) in scenarios:
+            cb = plugin.Class(None)
+            try:
+                ircs = connect(cb, networks, channels)
+                latencies = dict([(name, []) for name in handlers])
+                for (irc, name, msg) in stream(ircs, channels, mix, n):
+                    if name == '__call__':
+                        f = cb
+                    else:
+                        f = getattr(cb, name)
+                    start = timer()
+                    f(irc, msg)
+                    latencies[name].append(timer() - start)
+                    irc.sent = []
+            finally:
+                cb.die()
+            result = {}
+            for (name, values) in latencies.iteritems():
+                values.sort()
+                if values:
+                    total = sum(values)
+                    result[name] = (len(values), len(values) / total,
+                                    percentile(values, 0.5) * 1e6,
+                                    percentile(values, 0.9) * 1e6,
+                                    percentile(values, 0.99) * 1e6)
+            results['%s networks, %s channels, %s' %
+                    (networks, channels, mix)] = result
+    finally:
+        restore()
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns a list of (scenario, handler, rate, baseline rate) for every
+    handler running more than threshold slower than its baseline."""
+    regressions = []
+    for (scenario, result) in sorted(results.iteritems()):
+        for (name, numbers) in sorted(result.iteritems()):
+            try:
+                old = baseline[scenario][name]
+            except KeyError:
+                continue
+            if numbers[1] < old * (1 - threshold):
+                regressions.append((scenario, name, numbers[1], old))
+    return regressions
+
+def report(results, out=sys.stdout):
+    for (scenario, result) in sorted(results.iteritems()):
+        out.write('%s:\n' % scenario)
+        for name in handlers:
+            if name in result:
+                out.write('  %-10s %7d msgs %10.0f msgs/s  p50 %7.1fus  '
+                          'p90 %7.1fus  p99 %7.1fus\n' %
+                          ((name,) + result[name]))
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--messages', type='int', default=20000,
+                      help='messages per scenario [default: %default]')
+    parser.add_option('-t', '--threshold', type='float', default=0.2,
+                      help='fraction slower than the baseline that counts as '
+                           'a regression [default: %default]')
+    parser.add_option('--save', action='store_true', default=False,
+                      help='store the results as the new baseline')
+    parser.add_option('--baseline', default=baselineFile,
+                      help='baseline file [default: %default]')
+    (options, args) = parser.parse_args()
+    results = run(options.messages)
+    report(results)
+    if options.save:
+        fd = open(options.baseline, 'w')
+        try:
+            json.dump(dict([(scenario, dict([(name, numbers[1])
+                                             for (name, numbers)
+                                             in result.iteritems()]))
+                            for (scenario, result) in results.iteritems()]),
+                      fd, indent=4, sort_keys=True)
+        finally:
+            fd.close()
+        sys.stdout.write('Baseline saved to %s.\n' % options.baseline)
+        return 0
+    if not os.path.exists(options.baseline):
+        sys.stdout.write('No baseline in %s; run with --save to store one.\n'
+                         % options.baseline)
+        return 0
+    fd = open(options.baseline)
+    try:
+        baseline = json.load(fd)
+    finally:
+        fd.close()
+    regressions = compare(results, baseline, options.threshold)
+    for (scenario, name, rate, old) in regressions:
+        sys.stdout.write('REGRESSION in %s, %s: %.0f msgs/s, baseline %.0f '
+                         'msgs/s.\n' % (scenario, name, rate, old))
+    return regressions and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -45,43 +45,257 @@ def configure(advanced):
     botnick = something('What is the services Bot named?', default='P@cservice.netgamers.org')
     conf.supybot.plugins.NetGamers.botNick.setValue(botnick)
 
+# Supybot's registry can't tell anyone that a value changed, so the plugin's
+# values are all of classes that count changes here.  The plugin throws away
+# what it built from the registry whenever this has moved.
+generation = 0
+
+_watched = {}
+def watched(cls):
+    """Returns a subclass of the registry class cls that counts changes in
+    generation."""
+    try:
+        return _watched[cls]
+    except KeyError:
+        class Watched(cls):
+            def setValue(self, v):
+                global generation
+                # Values being made, like a channel's on its first use, have
+                # no name yet; setting those changes nothing we've built.
+                if self._name == 'unset':
+                    cls.setValue(self, v)
+                    return
+                old = self.value
+                cls.setValue(self, v)
+                if self.value != old:
+                    generation += 1
+        Watched.__name__ = cls.__name__
+        _watched[cls] = Watched
+        return Watched
+
+Boolean = watched(registry.Boolean)
+String = watched(registry.String)
+OnlySomeStrings = watched(registry.OnlySomeStrings)
+PositiveFloat = watched(registry.PositiveFloat)
+PositiveInteger = watched(registry.PositiveInteger)
+NonNegativeInteger = watched(registry.NonNegativeInteger)
+SpaceSeparatedSetOfStrings = watched(registry.SpaceSeparatedSetOfStrings)
+CommaSeparatedListOfStrings = watched(registry.CommaSeparatedListOfStrings)
+
 NetGamers = conf.registerPlugin('NetGamers')
 
 conf.registerGlobalValue(NetGamers, "reggedNick",
-    registry.String("", """The bots registered nick on the NetGamers network.
+    String("", """The bots registered nick on the NetGamers network.
     Nicks can be registered at http://www.netgamers.org."""))
 
 conf.registerGlobalValue(NetGamers, "useRegged",
-    registry.Boolean(False, """Determines if the regged neck should be 
+    Boolean(False, """Determines if the regged neck should be 
     used as the bots actual nick on the network."""))    
 
 conf.registerGlobalValue(NetGamers, "password",
-    registry.String("", """The password to use when identifying with P."""))
+    String("", """The password to use when identifying with P."""))
     
 conf.registerGlobalValue(NetGamers, "botNick",
-    registry.String("P@cservice.netgamers.org", """The nick/server used by the services
+    String("P@cservice.netgamers.org", """The nick/server used by the services
     bot on the network. On NetGamers,this is P@cservice.netgamers.org."""))
     
+conf.registerGlobalValue(NetGamers, 'networks',
+    SpaceSeparatedSetOfStrings(['NetGamers'], """Determines which
+    networks the plugin is enabled on.  A network matches by the name the bot
+    knows it by or by the name its server announces.  The register command
+    adds the network it's given on."""))
+
+conf.registerGlobalValue(NetGamers, 'verifyBotHost',
+    Boolean(False, """Determines whether the bot will only listen to
+    notices, MODEs and INVITEs from the services Bot if they come from
+    supybot.plugins.NetGamers.botHost, rather than from anyone using the
+    Bot's nick.  While botHost is empty, nothing is taken as coming from the
+    Bot."""))
+
+conf.registerGlobalValue(NetGamers, 'botHost',
+    String('', """The host or user@host the services Bot's messages
+    come from (for instance, cservice@netgamers.org for P).  Must be set for
+    supybot.plugins.NetGamers.verifyBotHost to let anything through."""))
+
+class PreLogin(OnlySomeStrings):
+    validStrings = ('off', 'sasl', 'pass')
+
+conf.registerGlobalValue(NetGamers, 'preLogin',
+    PreLogin('off', """Determines whether the bot will log in while it
+    connects, before the MOTD: 'sasl' logs in with SASL PLAIN, 'pass' sends
+    supybot.plugins.NetGamers.passFormat as the server password, and 'off'
+    waits for the end of the MOTD and sends LOGIN to the services Bot.  If
+    logging in early doesn't work, the bot falls back to LOGIN.  Limnoria
+    does SASL itself, configured in supybot.networks.<network>.sasl, so there
+    'sasl' falls back to LOGIN straight away."""))
+
+conf.registerGlobalValue(NetGamers, 'saslTimeout',
+    PositiveInteger(30, """Determines how many seconds the bot will
+    wait for SASL to finish while it connects before giving up on it and
+    ending capability negotiation, so the server lets it finish
+    connecting."""))
+
+conf.registerGlobalValue(NetGamers, 'passFormat',
+    String('$nick:$password', """Determines the server password the
+    bot sends when supybot.plugins.NetGamers.preLogin is 'pass'.  $nick and
+    $password are replaced with the registered nick and its password."""))
+
 conf.registerGlobalValue(NetGamers, 'noJoinsUntilIdentified',
-    registry.Boolean(False, """Determines whether the bot will not join any
+    Boolean(False, """Determines whether the bot will not join any
     channels until it is identified.  This may be useful, for instances, if
     you have a vhost that isn't set until you're identified, or if you're
     joining +r channels that won't allow you to join unless you identify."""))
 
+conf.registerGlobalValue(NetGamers, 'maxHeldJoins',
+    PositiveInteger(500, """Determines how many channels the bot will
+    hold JOINs for while it isn't identified.  JOINs to any more channels than
+    this are dropped."""))
+
+conf.registerGlobalValue(NetGamers, 'channelMemory',
+    NonNegativeInteger(30, """Determines how many days the bot will
+    remember that a channel needs it to be identified, invited or unbanned
+    before it can join.  Until then, the bot holds JOINs to such channels until
+    it's identified and asks the services Bot for an invite or unban instead of
+    trying the JOIN first.  0 means the bot won't remember anything."""))
+
 conf.registerGlobalValue(NetGamers, 'ghostDelay',
-    registry.PositiveInteger(60, """Determines how many seconds the bot will
+    PositiveInteger(60, """Determines how many seconds the bot will
     wait between successive GHOST attempts."""))
 
+conf.registerGlobalValue(NetGamers, 'watchInterval',
+    PositiveInteger(60, """Determines how many seconds apart the bot
+    asks the server (with ISON) whether someone is on its registered nick while
+    it isn't on it.  Servers that support MONITOR tell the bot as soon as the
+    nick frees up, so this isn't used on them."""))
+
+conf.registerGlobalValue(NetGamers, 'repeatInterval',
+    PositiveInteger(300, """Determines how many seconds apart the
+    bot logs a summary of the notices from the services Bot it has only
+    counted.  Of a run of like notices that would be logged (unexpected ones,
+    or refusals for lack of access), only the first is logged right away; the
+    rest are counted and summed up in the next summary."""))
+
+conf.registerGlobalValue(NetGamers, 'requestDelay',
+    PositiveInteger(10, """Determines how many seconds the bot will
+    wait for the services Bot to answer a command before asking again (see
+    supybot.plugins.NetGamers.requestRetries).  The wait doubles with every
+    try that goes unanswered, and the bot won't ask for an unban or invite it
+    has already asked for on its own until the wait is over."""))
+
+conf.registerGlobalValue(NetGamers, 'requestRetries',
+    NonNegativeInteger(2, """Determines how many times the bot will
+    send a command to the services Bot again when it gets no answer, before
+    giving up on it."""))
+
+conf.registerGlobalValue(NetGamers, 'servicesRate',
+    PositiveFloat(1.0, """Determines how many messages a second the
+    bot will send to the services Bot once it has used up its burst.  The bot
+    slows down on its own when the Bot complains about flooding."""))
+
+conf.registerGlobalValue(NetGamers, 'servicesBurst',
+    PositiveInteger(5, """Determines how many messages the bot may
+    send to the services Bot at once before being held to
+    supybot.plugins.NetGamers.servicesRate."""))
+
+conf.registerGlobalValue(NetGamers, 'collectStats',
+    Boolean(False, """Determines whether the bot will keep call
+    counts and timings for its message handlers, shown by the stats
+    command."""))
+
+conf.registerGlobalValue(NetGamers, 'eventLogSize',
+    NonNegativeInteger(1000, """Determines how many of its latest
+    dealings with the services Bot (commands sent and answered, notices,
+    MODEs, INVITEs) the bot remembers for the events command.  0 means
+    none."""))
+
 conf.registerChannelValue(NetGamers, 'op',
-    registry.Boolean(False, """Determines whether the bot will request to get
+    Boolean(False, """Determines whether the bot will request to get
     opped by the services Bot when it joins the channel."""))
 
 conf.registerChannelValue(NetGamers, 'halfop',
-    registry.Boolean(False, """Determines whether the bot will request to get
+    Boolean(False, """Determines whether the bot will request to get
     half-opped by the services Bot when it joins the channel."""))
 
 conf.registerChannelValue(NetGamers, 'voice',
-    registry.Boolean(False, """Determines whether the bot will request to get
+    Boolean(False, """Determines whether the bot will request to get
     voiced by the services Bot when it joins the channel."""))
 
+# The kinds of notices we understand from the services Bot, in the order they
+# are tried, with the phrases that identify them on P.  A '*' in a phrase
+# matches anything in between, and $nick is replaced by the registered nick.
+phrases = [
+    ('throttled', ['flood me will you', 'enough fun for now'],
+     """the bot is sending commands too fast"""),
+    ('unbanned', ['all bans', 'unbanned from'],
+     """the bot has been unbanned from a channel"""),
+    ('channelNotRegistered', ["isn't registered"],
+     """a channel isn't registered with the Bot"""),
+    ('channelRegistered', ['this channel has been registered'],
+     """a channel is registered with the Bot"""),
+    ('alreadyOpped', ['already opped'],
+     """the bot is already opped"""),
+    ('accessRequired', ['access level*is required'],
+     """a higher access level is required"""),
+    ('insufficientAccess', ['insufficient access'],
+     """the bot has insufficient access"""),
+    ('inviting', ['inviting'],
+     """the Bot is inviting the bot to a channel"""),
+    ('passwordIncorrect', ['incorrect', 'denied', 'authentication failed',
+                           'unable to authenticate'],
+     """the password was not accepted"""),
+    ('ghosted', ['killed*ghost', 'ghost*killed', 'killed*$nick',
+                 '$nick*killed'],
+     """the registered nick has been ghosted"""),
+    ('nickNotRegistered', ['is not registered', "don't know who"],
+     """the nick isn't registered"""),
+    ('nickOffline', ["currently*isn't", 'is not'],
+     """the registered nick isn't online"""),
+    ('nickRegistered', ['owned by someone else',
+                        'nickname is registered and protected',
+                        'nick belongs to another user'],
+     """the nick is registered to someone"""),
+    ('accepted', ['now recognized', 'already identified', 'password accepted',
+                  'now identified', 'authentication successful',
+                  'already authenticated'],
+     """the password was accepted"""),
+    ('motd', ['motd'],
+     """the Bot is sending its MOTD"""),
+]
+
+conf.registerGroup(NetGamers, 'phrases')
+for (name, default, help) in phrases:
+    conf.registerGlobalValue(NetGamers.phrases, name,
+        CommaSeparatedListOfStrings(default, """Determines which
+        phrases in a notice from the services Bot mean that %s.""" % help))
+
+def registerNetwork(network):
+    """Registers the group holding network's own settings.
+
+    Empty values in the network's group fall back to the plugin-wide ones.
+    """
+    group = conf.registerGroup(NetGamers, network)
+    conf.registerGlobalValue(group, 'reggedNick',
+        String('', """The bot's registered nick on %s.  If empty,
+        supybot.plugins.NetGamers.reggedNick is used.""" % network))
+    conf.registerGlobalValue(group, 'password',
+        String('', """The password to use when identifying with the
+        services Bot on %s.  If empty, supybot.plugins.NetGamers.password is
+        used.""" % network, private=True))
+    conf.registerGlobalValue(group, 'botNick',
+        String('', """The nick/server used by the services bot on
+        %s.  If empty, supybot.plugins.NetGamers.botNick is used.""" %
+        network))
+    conf.registerGlobalValue(group, 'botHost',
+        String('', """The host or user@host the services Bot's
+        messages on %s come from.  If empty,
+        supybot.plugins.NetGamers.botHost is used.""" % network))
+    conf.registerGroup(group, 'phrases')
+    for (name, default, help) in phrases:
+        conf.registerGlobalValue(group.phrases, name,
+            CommaSeparatedListOfStrings([], """Determines which
+            phrases in a notice from the services Bot on %s mean that %s.
+            If empty, supybot.plugins.NetGamers.phrases.%s is used.""" %
+            (network, help, name)))
+    return group
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
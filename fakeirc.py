@@ -0,0 +1,88 @@
+###
+# Copyright (c) 2009, Morten Lied Johansen
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Stand-ins for the parts of Supybot's Irc that the NetGamers plugin uses, so
+the plugin can be driven without a server.
+"""
+
+import supybot.irclib as irclib
+import supybot.ircutils as ircutils
+
+class FakeState(object):
+    def __init__(self, network):
+        self.channels = ircutils.IrcDict()
+        self.nicksToHostmasks = ircutils.IrcDict()
+        self.supported = {'NETWORK': network}
+
+class FakeIrc(object):
+    """Keeps everything the plugin sends instead of sending it."""
+    def __init__(self, network='NetGamers', nick='Bot', afterConnect=True):
+        self.network = network
+        self.nick = nick
+        self.afterConnect = afterConnect
+        self.state = FakeState(network)
+        self.sent = []
+
+    def sendMsg(self, msg):
+        self.sent.append(msg)
+    queueMsg = sendMsg
+
+    # What callbacks.Plugin.__call__ asks of the Irc it's given; Limnoria
+    # wraps it in a proxy that needs these.
+    def getRealIrc(self):
+        return self
+
+    def isChannel(self, s):
+        return ircutils.isChannel(s)
+
+    def _setMsgChannel(self, msg):
+        channel = None
+        if msg.args and self.isChannel(msg.args[0]):
+            channel = msg.args[0]
+        msg.channel = channel
+
+    def takeSent(self):
+        """Returns what has been sent since the last call."""
+        sent = self.sent
+        self.sent = []
+        return sent
+
+    def addChannel(self, channel, users=()):
+        """Puts us in channel with users, who may have @, % or + prefixes."""
+        state = irclib.ChannelState()
+        state.addUser(self.nick)
+        for user in users:
+            state.addUser(user)
+        self.state.channels[channel] = state
+        return state
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,245 @@
+###
+# Copyright (c) 2009, Morten Lied Johansen
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+A stand-in for P@cservice.netgamers.org, so the plugin's exchanges with the
+services Bot can be tested, and loaded, without the network.
+
+FakeServices reads the PRIVMSGs the plugin sends the Bot and answers with the
+notices, MODEs, INVITEs, QUITs and KILLs the network would send back.  How
+slow, how unreliable and how strict about flooding it is can be configured.
+pump() passes messages back and forth between it and a Supybot Irc (such as
+PluginTestCase's self.irc) until both are done.
+"""
+
+import time
+import heapq
+import random
+
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+
+class FakeServices(object):
+    """Answers LOGIN, RECOVER, op, halfop, voice, unban and invite like P.
+
+    accounts maps registered nicks to passwords, and access, if given, is the
+    set of channels we may get op/halfop/voice/unban/invite in.  holders maps
+    nicks that are online (other than ours) to their hostmasks.
+
+    Every answer is delivered latency seconds after the command.  With
+    probability errorRate a command is refused, and with probability
+    dropRate it is ignored altogether.  If rate is given, commands beyond a
+    token bucket of rate commands a second (burst deep) only get a flood
+    warning.
+    """
+    def __init__(self, accounts, access=None, holders=None,
+                 prefix='P!cservice@netgamers.org', latency=0, errorRate=0,
+                 dropRate=0, rate=None, burst=10, seed=0):
+        self.accounts = ircutils.IrcDict(accounts)
+        self.access = access
+        self.holders = ircutils.IrcDict(holders or {})
+        self.prefix = prefix
+        self.nick = ircutils.nickFromHostmask(prefix)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.dropRate = dropRate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.random = random.Random(seed)
+        self.loggedIn = None # The account we're logged in with, if any.
+        self.received = [] # Every command we've been sent.
+        self._replies = []
+        self._count = 0
+
+    def isForMe(self, target):
+        return ircutils.strEqual(target.split('@', 1)[0], self.nick)
+
+    def _reply(self, now, msg):
+        heapq.heappush(self._replies, (now + self.latency, self._count, msg))
+        self._count += 1
+
+    def _notice(self, now, nick, s):
+        self._reply(now, ircmsgs.notice(nick, s, prefix=self.prefix))
+
+    def _limited(self, now):
+        if self.rate is None:
+            return False
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def receive(self, nick, msg, now=None):
+        """Handles a PRIVMSG sent by nick, queueing the answers."""
+        if now is None:
+            now = time.time()
+        words = msg.args[1].split()
+        if not words:
+            return
+        self.received.append(msg.args[1])
+        if self._limited(now):
+            self._notice(now, nick, 'Flood me will you? I\'m not going to '
+                                    'listen to you anymore.')
+            return
+        if self.random.random() < self.dropRate:
+            return
+        command = words[0].lower()
+        f = getattr(self, 'do' + command.capitalize(), None)
+        if f is None:
+            self._notice(now, nick, 'Unknown command %s.' % words[0])
+        else:
+            f(now, nick, words[1:])
+
+    def _error(self):
+        return self.random.random() < self.errorRate
+
+    def doLogin(self, now, nick, args):
+        if len(args) != 2 or self._error() or \
+           self.accounts.get(args[0]) != args[1]:
+            self._notice(now, nick, 'Authentication failed.')
+        elif self.loggedIn is not None:
+            self._notice(now, nick, 'You are already authenticated.')
+        else:
+            self.loggedIn = args[0]
+            self._notice(now, nick,
+                         'Password accepted - you are now recognized.')
+
+    def doRecover(self, now, nick, args):
+        target = args[0]
+        password = args[-1]
+        if self._error() or self.accounts.get(target) != password:
+            self._notice(now, nick, 'Authentication failed.')
+        elif ircutils.strEqual(target, nick):
+            # The nick to recover is the one asking; off it goes.
+            self._reply(now, ircmsgs.IrcMsg(prefix=self.prefix, command='KILL',
+                                            args=(nick, 'Nick recovered')))
+        elif target in self.holders:
+            hostmask = self.holders.pop(target)
+            self._reply(now, ircmsgs.IrcMsg(prefix=hostmask, command='QUIT',
+                                            args=('Killed (%s (ghost))' %
+                                                  self.nick,)))
+            self._notice(now, nick,
+                         '\x02%s\x02 has been killed (ghost).' % target)
+        else:
+            self._notice(now, nick, '%s is not currently online.' % target)
+
+    def _channelCommand(self, now, nick, args):
+        """Returns the channel and nick a channel command is for, after
+        checking we may use it, or (None, None)."""
+        if not args:
+            self._notice(now, nick, 'Not enough parameters.')
+            return (None, None)
+        channel = args[0]
+        target = len(args) > 1 and args[1] or nick
+        if self.loggedIn is None or self._error() or \
+           (self.access is not None and channel not in self.access):
+            self._notice(now, nick, 'You have insufficient access to '
+                                    '\x02%s\x02.' % channel)
+            return (None, None)
+        return (channel, target)
+
+    def _mode(self, now, nick, args, mode):
+        (channel, target) = self._channelCommand(now, nick, args)
+        if channel is not None:
+            self._reply(now, ircmsgs.IrcMsg(prefix=self.prefix, command='MODE',
+                                            args=(channel, mode, target)))
+
+    def doOp(self, now, nick, args):
+        self._mode(now, nick, args, '+o')
+
+    def doHalfop(self, now, nick, args):
+        self._mode(now, nick, args, '+h')
+
+    def doVoice(self, now, nick, args):
+        self._mode(now, nick, args, '+v')
+
+    def doUnban(self, now, nick, args):
+        (channel, target) = self._channelCommand(now, nick, args)
+        if channel is not None:
+            self._notice(now, nick,
+                         'You have been unbanned from \x02%s\x02.' % channel)
+
+    def doInvite(self, now, nick, args):
+        (channel, target) = self._channelCommand(now, nick, args)
+        if channel is not None:
+            self._notice(now, nick, 'Inviting you to \x02%s\x02.' % channel)
+            self._reply(now, ircmsgs.IrcMsg(prefix=self.prefix,
+                                            command='INVITE',
+                                            args=(target, channel)))
+
+    def due(self, now=None):
+        """Returns the answers due by now, in order."""
+        if now is None:
+            now = time.time()
+        replies = []
+        while self._replies and self._replies[0][0] <= now:
+            replies.append(heapq.heappop(self._replies)[2])
+        return replies
+
+    def pending(self):
+        return len(self._replies)
+
+    def pump(self, irc, now=None):
+        """Passes messages between irc and us until neither has anything
+        more to say, and returns the messages irc sent that weren't for us.
+
+        If now is given, only answers due by now are delivered; otherwise
+        answers are delivered as they become due, so with a latency this
+        waits for them.
+        """
+        others = []
+        while True:
+            msg = irc.takeMsg()
+            while msg is not None:
+                if msg.command == 'PRIVMSG' and self.isForMe(msg.args[0]):
+                    self.receive(irc.nick, msg, now)
+                else:
+                    others.append(msg)
+                msg = irc.takeMsg()
+            replies = self.due(now)
+            if not replies:
+                if now is not None or not self._replies:
+                    return others
+                time.sleep(max(0, self._replies[0][0] - time.time()))
+                continue
+            for reply in replies:
+                if reply.command == 'KILL':
+                    # The server tells us it's killing us, then drops us.
+                    irc.feedMsg(reply)
+                    return others
+                irc.feedMsg(reply)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
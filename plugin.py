@@ -30,18 +30,606 @@
 
 import re
 import time
-from string import Template
+import json
+import base64
+import heapq
+import bisect
+import random
+import fnmatch
+from collections import namedtuple, deque
+from string import Template, maketrans, ascii_uppercase, ascii_lowercase
 
 import config
 
 import supybot.conf as conf
+import supybot.ircdb as ircdb
 import supybot.utils as utils
+import supybot.world as world
 from supybot.commands import *
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
+import supybot.schedule as schedule
+import supybot.registry as registry
 import supybot.callbacks as callbacks
 from supybot.registry import NonExistentRegistryEntry
 
+# Immutable view of the registry values a network needs on every message.
+# Built once per network and thrown away whenever a registry value changes.
+Settings = namedtuple('Settings', ['reggedNick', 'useRegged', 'password',
+                                   'botNick', 'botHost', 'verifyBotHost',
+                                   'ghostDelay', 'watchInterval',
+                                   'noJoinsUntilIdentified', 'servicesRate',
+                                   'servicesBurst', 'preLogin', 'passFormat',
+                                   'requestDelay', 'requestRetries',
+                                   'classifier'])
+
+# A classified notice from the services Bot: the kind of notice (one of the
+# names in config.phrases, or None), the bold channel or nick in it, if any,
+# and the lowered text without formatting.
+Notice = namedtuple('Notice', ['event', 'target', 'text'])
+
+class NoticeClassifier(object):
+    """Classifies notices from the services Bot with a single regexp scan.
+
+    table is a list of (event, phrases) pairs in priority order.  All phrases
+    are compiled into one alternation inside a lookahead, so every position in
+    the notice is tried once and the first event in the table wins no matter
+    where in the notice its phrase is found.
+    """
+    _chanRe = re.compile('\x02(.*?)\x02')
+    def __init__(self, table, nick=''):
+        alternatives = []
+        self._events = [None]
+        for (event, phrases) in table:
+            patterns = [self._compile(phrase, nick) for phrase in phrases]
+            patterns = [pattern for pattern in patterns if pattern]
+            if patterns:
+                alternatives.append('(%s)' % '|'.join(patterns))
+                self._events.append(event)
+        if alternatives:
+            self._re = re.compile('(?=(?:%s))' % '|'.join(alternatives), re.S)
+        else:
+            self._re = None
+
+    def _compile(self, phrase, nick):
+        parts = []
+        for part in phrase.lower().split('*'):
+            part = Template(part).safe_substitute(nick=nick.lower())
+            if part:
+                parts.append(re.escape(part))
+        return '.*?'.join(parts)
+
+    def classify(self, text):
+        """Returns the Notice for the raw notice text."""
+        text = text.lower()
+        target = None
+        m = self._chanRe.search(text)
+        if m is not None:
+            target = ircutils.stripFormatting(m.group(1))
+        s = ircutils.stripFormatting(text)
+        best = len(self._events)
+        if self._re is not None:
+            for m in self._re.finditer(s):
+                if m.lastindex < best:
+                    best = m.lastindex
+                    if best == 1:
+                        break
+        if best == len(self._events):
+            return Notice(None, target, s)
+        return Notice(self._events[best], target, s)
+
+def joins(channels, limit=512):
+    """Packs (channel, key) pairs into as few JOIN messages as fit in limit
+    bytes each."""
+    # Keys are matched to channels by position, so keyed channels go first.
+    channels = [(c, k) for (c, k) in channels if k] + \
+               [(c, k) for (c, k) in channels if not k]
+    msgs = []
+    chans = []
+    keys = []
+    base = len('JOIN :\r\n') # IrcMsg puts a ':' before the last argument.
+    size = base
+    for (channel, key) in channels:
+        extra = len(channel) + bool(chans)
+        if key:
+            extra += len(key) + 1
+        if chans and size + extra > limit:
+            msgs.append(ircmsgs.joins(chans, keys or None))
+            chans = []
+            keys = []
+            size = base
+            extra = len(channel) + (key and len(key) + 1 or 0)
+        chans.append(channel)
+        if key:
+            keys.append(key)
+        size += extra
+    if chans:
+        msgs.append(ircmsgs.joins(chans, keys or None))
+    return msgs
+
+class ServicesQueue(object):
+    """Paces the messages we send to the services Bot on one network.
+
+    Messages go out in order of priority through a token bucket holding up to
+    burst tokens, refilled at rate tokens a second.  The rate is halved each
+    time the Bot says we're too fast, and climbs back to the configured rate
+    as the Bot answers normally again.
+    """
+    priorities = {'LOGIN': 0, 'RECOVER': 1, 'unban': 2, 'invite': 2,
+                  'op': 3, 'halfop': 4, 'voice': 5}
+    def __init__(self, rate, burst):
+        self.baseRate = self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.event = None # Name of the scheduled flush, if any.
+        self._heap = []
+        self._count = 0 # Keeps messages of the same priority in order.
+
+    def __len__(self):
+        return len(self._heap)
+
+    def configure(self, rate, burst):
+        if rate != self.baseRate or burst != self.burst:
+            self.baseRate = self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def put(self, msg):
+        command = msg.args[1].split(None, 1)[0]
+        priority = self.priorities.get(command, len(self.priorities))
+        heapq.heappush(self._heap, (priority, self._count, msg))
+        self._count += 1
+
+    def take(self):
+        """Returns the next message if the rate allows sending it now."""
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self._heap and self.tokens >= 1:
+            self.tokens -= 1
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def messages(self):
+        """Returns the messages waiting to be sent, in order."""
+        return [msg for (priority, count, msg) in sorted(self._heap)]
+
+    def wait(self):
+        """Returns how many seconds until the next message may be sent."""
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def throttle(self):
+        self.rate = max(self.baseRate / 16, self.rate / 2)
+        self.tokens = 0
+
+    def recover(self):
+        self.rate = min(self.baseRate, self.rate * 1.25)
+
+class BotMatcher(object):
+    """Recognizes messages from the services Bot on one connection.
+
+    The nick part of botNick is folded once, the way the server's CASEMAPPING
+    says, so each check is one translate and one comparison.  If host is
+    given, the message must also come from that host or user@host.
+    """
+    _tables = {
+        'ascii': maketrans(ascii_uppercase, ascii_lowercase),
+        'rfc1459': maketrans(ascii_uppercase + '[]\\~',
+                             ascii_lowercase + '{}|^'),
+        'strict-rfc1459': maketrans(ascii_uppercase + '[]\\',
+                                    ascii_lowercase + '{}|'),
+    }
+    def __init__(self, botNick, casemapping='rfc1459', host=None):
+        self.table = self._tables.get(casemapping, self._tables['rfc1459'])
+        self.nick = botNick.split('@', 1)[0].translate(self.table)
+        self.host = host and host.lower()
+
+    def __call__(self, msg):
+        if not self.nick or msg.nick.translate(self.table) != self.nick:
+            return False
+        return not self.host or \
+            self.host in (msg.host.lower(),
+                          ('%s@%s' % (msg.user, msg.host)).lower())
+
+class ModeParser(object):
+    """Splits a channel MODE into (sign, mode, argument) changes in one pass.
+
+    Which modes take an argument comes from the server's PREFIX and CHANMODES
+    (RFC 1459's if it didn't send them): the PREFIX modes and CHANMODES' first
+    two kinds always do, the third kind only when set, and any other mode
+    never does.
+    """
+    def __init__(self, prefix=None, chanmodes=None):
+        if not prefix:
+            prefix = '(ov)@+'
+        if isinstance(prefix, dict): # Supybot may have parsed it already.
+            prefix = ''.join(prefix.keys())
+        elif prefix.startswith('('):
+            prefix = prefix[1:].split(')', 1)[0]
+        else:
+            prefix = ''
+        # Only 005's CHANMODES says which kind each mode is; what 004 left
+        # under the same name (a string, or a frozenset in Limnoria) doesn't.
+        if not isinstance(chanmodes, basestring) or ',' not in chanmodes:
+            chanmodes = 'b,k,l,imnpst'
+        chanmodes = (chanmodes.split(',') + ['', '', '', ''])[:4]
+        self.always = frozenset(prefix + chanmodes[0] + chanmodes[1])
+        self.whenSet = frozenset(chanmodes[2])
+
+    def parse(self, args):
+        """Returns the changes in args, a MODE's arguments after its target."""
+        changes = []
+        sign = '+'
+        i = 1
+        for mode in args[0]:
+            if mode in '+-':
+                sign = mode
+            elif mode in self.always or \
+                 (sign == '+' and mode in self.whenSet):
+                if i < len(args):
+                    changes.append((sign, mode, args[i]))
+                    i += 1
+            else:
+                changes.append((sign, mode, None))
+        return changes
+
+# Where we are in reclaiming the registered nick: not trying, waiting for the
+# answer to a NICK, waiting for the answer to a RECOVER, or waiting for the
+# backoff timer before the next attempt.
+IDLE = 'idle'
+NICK_REQUESTED = 'nick-requested'
+RECOVERING = 'recovering'
+WAITING = 'waiting'
+
+class ChannelKnowledge(object):
+    """What we've learned about joining channels on each network: whether a
+    channel needs us to be identified ('identify'), invited ('invite') or
+    unbanned ('unban') first.
+
+    Kept in a JSON file so it survives restarts; each need is forgotten
+    maxAge seconds after it was last seen.
+    """
+    def __init__(self, filename, log):
+        self.filename = filename
+        self.log = log
+        self.dirty = False
+        self.networks = {} # network -> channel -> need -> when last seen
+        try:
+            fd = open(filename)
+        except EnvironmentError:
+            return
+        try:
+            try:
+                for (network, channels) in json.load(fd).iteritems():
+                    self.networks[network] = ircutils.IrcDict(channels)
+            except ValueError, e:
+                self.log.warning('Couldn\'t read %s: %s', filename, e)
+        finally:
+            fd.close()
+
+    def needs(self, network, channel, maxAge):
+        """Returns the set of things channel needs, as of maxAge seconds
+        ago."""
+        try:
+            needs = self.networks[network][channel]
+        except KeyError:
+            return frozenset()
+        since = time.time() - maxAge
+        return frozenset([need for (need, when) in needs.iteritems()
+                          if when >= since])
+
+    def learn(self, network, channel, need):
+        channels = self.networks.setdefault(network, ircutils.IrcDict())
+        channels.setdefault(channel, {})[need] = time.time()
+        self.dirty = True
+
+    def forget(self, network, channel, need):
+        try:
+            needs = self.networks[network][channel]
+            del needs[need]
+        except KeyError:
+            return
+        if not needs:
+            del self.networks[network][channel]
+        self.dirty = True
+
+    def flush(self, maxAge=None):
+        if maxAge is not None:
+            since = time.time() - maxAge
+            for channels in self.networks.itervalues():
+                for (channel, needs) in channels.items():
+                    for (need, when) in needs.items():
+                        if when < since:
+                            del needs[need]
+                            self.dirty = True
+                    if not needs:
+                        del channels[channel]
+        if not self.dirty:
+            return
+        fd = utils.file.AtomicFile(self.filename)
+        json.dump(dict([(network, dict(channels.items()))
+                        for (network, channels) in self.networks.iteritems()]),
+                  fd)
+        fd.close()
+        self.dirty = False
+
+class HandlerStats(object):
+    """Call count, total time and a latency histogram for one handler."""
+    # Upper bounds of the histogram buckets, in seconds; the last bucket
+    # takes everything slower.
+    bounds = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03)
+    __slots__ = ('calls', 'total', 'buckets')
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.buckets[bisect.bisect_left(self.bounds, elapsed)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p'th
+        percentile, or None if it's in the last bucket."""
+        wanted = self.calls * p
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                break
+        if i < len(self.bounds):
+            return self.bounds[i]
+        return None
+
+    def bound(self, p):
+        """Describes the p'th percentile in seconds, for replies."""
+        seconds = self.percentile(p)
+        if seconds is None:
+            return 'over %ss' % self.bounds[-1]
+        return 'under %ss' % seconds
+
+class LatencyStats(HandlerStats):
+    """How long the services Bot takes to answer one kind of command, and
+    how often it doesn't."""
+    bounds = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+    __slots__ = ('timeouts',)
+    def __init__(self):
+        HandlerStats.__init__(self)
+        self.timeouts = 0
+
+class StartupStats(HandlerStats):
+    """How long connections have taken to get through one phase of
+    starting up."""
+    bounds = (0.5, 1, 2, 5, 10, 30, 60, 120)
+    __slots__ = ()
+
+class Request(object):
+    """A command sent to the services Bot that hasn't been answered yet."""
+    __slots__ = ('text', 'queued', 'sent', 'attempts', 'deadline', 'abandoned')
+    def __init__(self, text):
+        self.text = text
+        self.queued = None # When it was last queued...
+        self.sent = None # ... and actually sent.
+        self.attempts = 0
+        self.deadline = 0 # When to try again, or give up.
+        self.abandoned = False
+
+class Stats(object):
+    """Per-network HandlerStats and counters.
+
+    Only exists while supybot.plugins.NetGamers.collectStats is on, when the
+    handlers are replaced on the plugin instance by timed wrappers, so it
+    costs nothing at all while off.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.since = {} # network -> when it was last reset, if it was
+        self.handlers = {} # network -> name -> HandlerStats
+        self.counters = {} # network -> name -> count
+
+    def timed(self, name, f):
+        def timed(irc, *args):
+            start = time.time()
+            try:
+                return f(irc, *args)
+            finally:
+                elapsed = time.time() - start
+                try:
+                    stats = self.handlers[irc.network][name]
+                except KeyError:
+                    stats = HandlerStats()
+                    self.handlers.setdefault(irc.network, {})[name] = stats
+                stats.add(elapsed)
+        return timed
+
+    def count(self, network, name):
+        counters = self.counters.setdefault(network, {})
+        counters[name] = counters.get(name, 0) + 1
+
+    def snapshot(self, network, reset=False):
+        """Returns (since, handlers, counters) for network as they are now,
+        and starts network over if reset is True."""
+        since = self.since.get(network, self.started)
+        if reset:
+            self.since[network] = time.time()
+            return (since, self.handlers.pop(network, {}),
+                    self.counters.pop(network, {}))
+        return (since, dict(self.handlers.get(network, {})),
+                dict(self.counters.get(network, {})))
+
+class EventLog(object):
+    """The last size things the plugin did with or heard from the services
+    Bot, on all networks, as (time, network, event, target, detail) tuples.
+    """
+    fields = ('time', 'network', 'event', 'target', 'detail')
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+
+    def resize(self, size):
+        self.events = deque(self.events, maxlen=size)
+
+    def add(self, network, event, target=None, detail=None):
+        self.events.append((time.time(), network, event, target, detail))
+
+    def select(self, network=None, event=None, target=None, since=None):
+        """Yields the events matching all the filters given, oldest first, as
+        dicts."""
+        if target is not None:
+            target = ircutils.toLower(target)
+        for values in list(self.events):
+            (when, eventNetwork, name, eventTarget, detail) = values
+            if since is not None and when < since:
+                continue
+            if network is not None and network != eventNetwork:
+                continue
+            if event is not None and event != name:
+                continue
+            if target is not None and (eventTarget is None or
+                                       ircutils.toLower(eventTarget) != target):
+                continue
+            yield dict(zip(self.fields, values))
+
+class RepeatLog(object):
+    """Keeps runs of like log messages from flooding the log.
+
+    The first message of a kind (a key, such as the kind of notice from the
+    Bot) on a network is logged right away; the ones after it are only
+    counted until flush(), which logs how many there were with the latest
+    text and starts over.  So it holds one entry per kind of message seen
+    since the last flush.
+    """
+    _channelRe = re.compile(r'[#&]\S+')
+    _numberRe = re.compile(r'\d+')
+    def __init__(self, log):
+        self.log = log
+        self.repeats = {} # (network, key) -> [level, count, latest text]
+
+    def normalize(self, text):
+        """Returns a key for text that's the same for texts differing only
+        in channels and numbers."""
+        return self._numberRe.sub('N', self._channelRe.sub('#', text))
+
+    def add(self, level, network, key, text, s, *args):
+        """Logs s % args at level, unless a message with the same key on
+        network has been logged since the last flush, in which case it's
+        counted, with text as the latest."""
+        entry = self.repeats.get((network, key))
+        if entry is None:
+            self.repeats[(network, key)] = [level, 0, text]
+            getattr(self.log, level)(s, *args)
+        else:
+            entry[1] += 1
+            entry[2] = text
+
+    def flush(self):
+        for ((network, key), (level, count, text)) in \
+                sorted(self.repeats.iteritems()):
+            if count:
+                getattr(self.log, level)('%s more like that (%s) from Bot on '
+                                         '%s; the latest: %r.', count, key,
+                                         network, text)
+        self.repeats.clear()
+
+class NetworkState(object):
+    """What the plugin keeps track of for its connection to one network.
+
+    A fresh one is made when we start registering with the server (or on 001,
+    if we never saw that) and dropped when the connection goes away, so
+    nothing carries over between connections or between networks.  Across a
+    reload of the plugin, it's handed over with save() and restore().
+    """
+    __slots__ = ('identified', 'sentGhost', 'steady', 'waitingJoins',
+                 'queue', 'reclaim', 'attempts', 'reclaimEvent',
+                 'registered', 'preLogin', 'preLoginEvent', 'cleared',
+                 'requests',
+                 'requestEvent', 'requestDue', 'enabled', 'isBot',
+                 'deficits', 'modes', 'watching', 'holderOnline',
+                 'watchEvent', 'startup', 'joining', 'joined', 'askedJoins',
+                 'helped', 'loginFailed')
+    def __init__(self, settings):
+        # Whether the plugin is enabled on this connection; None until it's
+        # been worked out (see _isEnabled).
+        self.enabled = None
+        self.isBot = None # A BotMatcher, once we need one.
+        self.modes = None # Likewise for a ModeParser.
+        self.registered = False
+        # None, or how far logging in while registering got: 'cap', 'sasl',
+        # 'pass' (sent, but no answer yet), 'done' or 'failed'.
+        self.preLogin = None
+        self.preLoginEvent = None
+        self.identified = False
+        # Whether logging in failed, or can't happen for want of settings, so
+        # there's no point holding JOINs until we're identified.
+        self.loginFailed = False
+        self.sentGhost = None
+        self.steady = False
+        self.reclaim = IDLE
+        self.attempts = 0
+        self.reclaimEvent = None
+        # How we learn whether the registered nick is taken: None, 'monitor'
+        # or 'ison' (see NetGamers._watchNick).  holderOnline is what the
+        # server last told us, or None if it hasn't yet.
+        self.watching = None
+        self.holderOnline = None
+        self.watchEvent = None
+        self.waitingJoins = ircutils.IrcDict() # Channel -> key.
+        # Channels the Bot has just invited us to or unbanned us from, whose
+        # JOINs mustn't be held back again.
+        self.cleared = ircutils.IrcSet()
+        # Channel -> key, for the JOINs _planJoin swapped for an unban or
+        # invite request, sent anyway if the Bot refuses or doesn't answer.
+        self.askedJoins = ircutils.IrcDict()
+        # Channels the Bot has let us into, until our JOIN arrives.
+        self.helped = ircutils.IrcSet()
+        # (command, lowercased target) -> Request, for what the Bot hasn't
+        # answered yet.
+        self.requests = {}
+        self.requestEvent = None
+        self.requestDue = None
+        # Channel -> the privileges we want there but lack (see
+        # NetGamers._deficit), or None when it must be rebuilt.
+        self.deficits = ircutils.IrcDict()
+        # Milestone -> when we got to it (see NetGamers._milestone), and for
+        # channels, (when, whether it was while starting up) of the JOIN going
+        # out and then of the end of NAMES, until we get op or voice there.
+        self.startup = {}
+        self.joining = ircutils.IrcDict()
+        self.joined = ircutils.IrcDict()
+        self.queue = ServicesQueue(settings.servicesRate,
+                                   settings.servicesBurst)
+
+    # What survives a reload, besides the queue and the requests.  The rest is
+    # worked out again, or belongs to timers that die with the old plugin.
+    _saved = ('registered', 'preLogin', 'identified', 'loginFailed',
+              'sentGhost', 'attempts',
+              'waitingJoins', 'cleared', 'askedJoins', 'helped',
+              'watching', 'holderOnline')
+
+    def save(self):
+        """Returns what restore() needs, in types that don't come from this
+        module, so a reloaded module can still read them."""
+        saved = dict([(name, getattr(self, name)) for name in self._saved])
+        saved['queue'] = self.queue.messages()
+        saved['requests'] = dict([(key, (r.text, r.queued, r.sent, r.attempts,
+                                         r.deadline, r.abandoned))
+                                  for (key, r) in self.requests.iteritems()])
+        return saved
+
+    def restore(self, saved):
+        self.deficits = None # We've been in channels all along.
+        for name in self._saved:
+            if name in saved:
+                setattr(self, name, saved[name])
+        for msg in saved.get('queue', ()):
+            self.queue.put(msg)
+        for (key, values) in saved.get('requests', {}).iteritems():
+            request = self.requests[key] = Request(values[0])
+            (request.queued, request.sent, request.attempts,
+             request.deadline, request.abandoned) = values[1:]
+
 class NetGamers(callbacks.Plugin):
     """This plugin handles dealing with Bot-style Services on networks that provide them.
     Basically, you should use the "password" command to tell the bot a nick to
@@ -51,90 +639,688 @@ class NetGamers(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(NetGamers, self)
         self.__parent.__init__(irc)
-        self.reset()
+        self._settings = {}
+        self._networks = set()
+        self._states = {}
+        self._stats = None
+        self._latencies = {} # network -> command -> LatencyStats
+        self._startup = {} # network -> phase -> deque of seconds
+        self._events = EventLog(self.registryValue('eventLogSize'))
+        self._repeats = RepeatLog(self.log)
+        self._repeatsEvent = None
+        filename = conf.supybot.directories.data.dirize('NetGamers.json')
+        self._knowledge = ChannelKnowledge(filename, self.log)
+        world.flushers.append(self._flushKnowledge)
+        self._registryStamp = None
+        self._checkRegistry()
+        self._takeHandoff()
 
-    def reset(self):
-        self.channels = []
-        self.sentGhost = None
-        self.identified = False
-        self.waitingJoins = []
+    def die(self):
+        if self._flushKnowledge not in world.flushers:
+            return # We're dead already.
+        world.flushers.remove(self._flushKnowledge)
+        self._flushKnowledge()
+        self._removeEvent(self._repeatsEvent)
+        self._repeats.flush()
+        # Leave our connections' state for the instance that replaces us if
+        # we're being reloaded; see _takeHandoff.
+        handoff = {}
+        for irc in world.ircs:
+            state = self._states.get(irc.network)
+            if state is not None and state.registered:
+                handoff[irc.network] = (irc, state.save())
+        world.NetGamersHandoff = (time.time(), handoff)
+        for network in self._states.keys():
+            self._dropState(network)
+        self.__parent.die()
+
+    # How many seconds after the old instance died we'll still take over its
+    # state.  A reload replaces it right away.
+    handoffAge = 60
+
+    def _takeHandoff(self):
+        """Takes over the state the instance we replace left for the
+        connections that are still up, so a reload sends nothing: no LOGIN,
+        no RECOVER and no op/voice requests."""
+        (when, handoff) = getattr(world, 'NetGamersHandoff', (0, {}))
+        world.NetGamersHandoff = (0, {})
+        if time.time() - when > self.handoffAge:
+            return
+        for irc in world.ircs:
+            try:
+                (old, saved) = handoff[irc.network]
+            except KeyError:
+                continue
+            if old is not irc:
+                continue # The connection we had state for is gone.
+            state = self._newState(irc)
+            state.restore(saved)
+            self._updateSteady(irc)
+            if state.queue:
+                self._flushQueue(irc, state)
+            self._watchRequests(irc, state)
+            if state.watching == 'ison':
+                self._isonLater(irc, state)
+            self.log.info('Took over the state for %s from before the '
+                          'reload.', irc.network)
+
+    # (attribute, name in the stats) of the handlers we time, and of
+    # _getDeficits, where working out what to ask the Bot for goes.  __call__
+    # is timed through _call, since Python looks special methods up on the
+    # class, not the instance.
+    _timedHandlers = [('_call', '__call__'), ('doNotice', 'doNotice'),
+                      ('_getDeficits', '_getDeficits'),
+                      ('outFilter', 'outFilter')]
+    def _setupStats(self):
+        if self.registryValue('collectStats'):
+            if self._stats is None:
+                self._stats = Stats()
+                for (attr, name) in self._timedHandlers:
+                    f = self._stats.timed(name, getattr(self, attr))
+                    setattr(self, attr, f)
+        elif self._stats is not None:
+            self._stats = None
+            for (attr, name) in self._timedHandlers:
+                delattr(self, attr)
+
+    def _resizeEvents(self):
+        self._events.resize(self.registryValue('eventLogSize'))
+
+    def _event(self, irc, event, target=None, detail=None):
+        self._events.add(irc.network, event, target, detail)
+
+    def _flushKnowledge(self):
+        self._knowledge.flush(self.registryValue('channelMemory') * 86400)
+
+    def _learn(self, irc, channel, need):
+        if self.registryValue('channelMemory'):
+            self._knowledge.learn(irc.network, channel, need)
+
+    def _checkRegistry(self):
+        """Throws away everything built from the registry if any of the
+        plugin's values changed since (see config.generation), or the registry
+        file was read again."""
+        stamp = (config.generation, registry._lastModified)
+        if stamp != self._registryStamp:
+            self._registryStamp = stamp
+            self._flushSettings()
+
+    def _flushSettings(self):
+        self._setupStats()
+        self._resizeEvents()
+        self._settings.clear()
+        for state in self._states.itervalues():
+            state.steady = False
+            state.enabled = None
+            state.isBot = None
+            state.modes = None
+            state.deficits = None
+
+    def _networkValue(self, network, name):
+        """Returns network's own value for name, or the plugin-wide value if
+        the network's is empty or network has no group of its own."""
+        value = None
+        if network in self._networks:
+            value = self.registryValue('%s.%s' % (network, name))
+        return value or self.registryValue(name)
+
+    def _registerNetwork(self, network):
+        """Returns the registry group with network's own settings, registering
+        it first if needed."""
+        if network not in self._networks:
+            config.registerNetwork(network)
+            self._networks.add(network)
+        return self.registryValue(network, value=False)
+
+    def _getSettings(self, network):
+        """Returns the Settings snapshot for network, building it if needed."""
+        self._checkRegistry()
+        try:
+            return self._settings[network]
+        except KeyError:
+            # Only networks we're enabled on get a group of their own; see
+            # _isEnabled for those enabled by the name their server announces.
+            if network in self.registryValue('networks'):
+                self._registerNetwork(network)
+            reggedNick = self._networkValue(network, 'reggedNick')
+            botNick = self._networkValue(network, 'botNick')
+            table = [(name, self._networkValue(network, 'phrases.' + name))
+                     for (name, default, help) in config.phrases]
+            settings = Settings(reggedNick=reggedNick,
+                                useRegged=self.registryValue('useRegged'),
+                                password=
+                                    self._networkValue(network, 'password'),
+                                botNick=botNick,
+                                botHost=
+                                    self._networkValue(network, 'botHost'),
+                                verifyBotHost=
+                                    self.registryValue('verifyBotHost'),
+                                ghostDelay=self.registryValue('ghostDelay'),
+                                watchInterval=
+                                    self.registryValue('watchInterval'),
+                                noJoinsUntilIdentified=
+                                    self.registryValue('noJoinsUntilIdentified'),
+                                servicesRate=self.registryValue('servicesRate'),
+                                servicesBurst=
+                                    self.registryValue('servicesBurst'),
+                                preLogin=self.registryValue('preLogin'),
+                                passFormat=self.registryValue('passFormat'),
+                                requestDelay=
+                                    self.registryValue('requestDelay'),
+                                requestRetries=
+                                    self.registryValue('requestRetries'),
+                                classifier=NoticeClassifier(table, reggedNick))
+            self._settings[network] = settings
+            return settings
+
+    def _getState(self, irc):
+        """Returns the NetworkState for irc's network, making it if needed."""
+        try:
+            return self._states[irc.network]
+        except KeyError:
+            return self._newState(irc)
+
+    def _newState(self, irc):
+        self._dropState(irc.network)
+        settings = self._getSettings(irc.network)
+        state = self._states[irc.network] = NetworkState(settings)
+        return state
+
+    def _dropState(self, network):
+        state = self._states.pop(network, None)
+        if state is not None:
+            self._removeEvent(state.queue.event)
+            self._removeEvent(state.reclaimEvent)
+            self._removeEvent(state.requestEvent)
+            self._removeEvent(state.watchEvent)
+            self._removeEvent(state.preLoginEvent)
+
+    def _removeEvent(self, name):
+        if name is not None:
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+
+    def _sendToBot(self, irc, s, request=None, again=True, flush=True):
+        """Queues s for the services Bot and sends as much as the rate allows.
+
+        The queue is flushed right away, so with tokens to spare this sends s
+        immediately (with irc.sendMsg, ahead of any queued JOINs).
+
+        If request is a (command, target) pair, s is kept until the Bot
+        answers it (see _answer) and sent again if it doesn't.  Unless again
+        is True, s isn't sent at all while the same request is waiting for an
+        answer.  With flush False, s is only queued, for the caller to flush
+        the queue once it's queued a batch.  Returns whether s was queued.
+        """
+        state = self._getState(irc)
+        msg = ircmsgs.privmsg(self._getBotNick(irc.network), s)
+        if request is not None:
+            key = self._expect(irc, state, request, s, again)
+            if key is None:
+                return False
+            msg.tag('NetGamers.request', key)
+        state.queue.put(msg)
+        if flush:
+            self._flushQueue(irc, state)
+        return True
+
+    def _flushQueue(self, irc, state):
+        settings = self._getSettings(irc.network)
+        queue = state.queue
+        queue.configure(settings.servicesRate, settings.servicesBurst)
+        msg = queue.take()
+        while msg is not None:
+            key = msg.tagged('NetGamers.request')
+            if key is not None:
+                request = state.requests.get(key)
+                if request is not None:
+                    request.sent = time.time()
+            irc.sendMsg(msg)
+            msg = queue.take()
+        if queue and queue.event is None:
+            def flush():
+                queue.event = None
+                if self._states.get(irc.network) is state:
+                    self._flushQueue(irc, state)
+            queue.event = schedule.addEvent(flush, time.time() + queue.wait(),
+                                            'NetGamers.queue.%s' % irc.network)
+
+    def _expect(self, irc, state, request, s, again):
+        """Records that we're sending s as request, a (command, target) pair,
+        and returns its key in state.requests, or None if again is False and
+        it's still waiting for an answer."""
+        (command, target) = request
+        key = (command, target and ircutils.toLower(target))
+        now = time.time()
+        request = state.requests.get(key)
+        if request is None or (request.abandoned and now >= request.deadline):
+            request = state.requests[key] = Request(s)
+        elif not again and now < request.deadline:
+            self.log.debug('Not asking Bot to %s %s again for another %.0f '
+                           'seconds.', command, target, request.deadline - now)
+            return None
+        base = self._getSettings(irc.network).requestDelay
+        request.text = s
+        request.queued = now
+        request.deadline = now + min(base * 2 ** request.attempts, base * 64)
+        request.attempts += 1
+        request.abandoned = False
+        self._event(irc, 'sent', target, command)
+        if state.requestDue is None or request.deadline < state.requestDue:
+            self._watchRequests(irc, state, request.deadline)
+        return key
+
+    def _watchRequests(self, irc, state, when=None):
+        """(Re)arms the timer that checks on unanswered requests at when, or
+        the earliest deadline."""
+        self._removeEvent(state.requestEvent)
+        state.requestEvent = state.requestDue = None
+        if when is None:
+            if not state.requests:
+                return
+            when = min([r.deadline for r in state.requests.itervalues()])
+        def check():
+            state.requestEvent = state.requestDue = None
+            if self._states.get(irc.network) is state:
+                self._checkRequests(irc, state)
+        state.requestDue = when
+        state.requestEvent = schedule.addEvent(check, when,
+                                               'NetGamers.requests.%s' %
+                                               irc.network)
+
+    # The commands we send again when the Bot doesn't answer.  Not RECOVER,
+    # which the reclaim machine already tries again on its own schedule.
+    _retried = frozenset(['LOGIN', 'op', 'halfop', 'voice', 'unban', 'invite'])
+
+    def _checkRequests(self, irc, state):
+        """Sends the requests the Bot hasn't answered in time again, or gives
+        up on them."""
+        now = time.time()
+        settings = self._getSettings(irc.network)
+        for (key, request) in state.requests.items():
+            if now < request.deadline:
+                continue
+            (command, target) = key
+            if request.abandoned:
+                del state.requests[key]
+            elif command in self._retried and \
+                 request.attempts <= settings.requestRetries:
+                self.log.info('No answer from Bot to %s %s on %s, asking '
+                              'again.', command, target, irc.network)
+                self._event(irc, 'retry', target, command)
+                self._sendToBot(irc, request.text, key)
+            else:
+                self.log.warning('No answer from Bot to %s %s on %s, giving '
+                                 'up.', command, target, irc.network)
+                self._event(irc, 'timeout', target, command)
+                self._latency(irc.network, command).timeouts += 1
+                if command in ('unban', 'invite'):
+                    self._joinAnyway(irc, state, target)
+                elif command == 'LOGIN':
+                    self._loginFailed(irc)
+                # Kept until the next deadline, so it isn't asked for again
+                # right away.
+                request.abandoned = True
+                base = settings.requestDelay
+                request.deadline = now + min(base * 2 ** request.attempts,
+                                             base * 64)
+        self._watchRequests(irc, state)
+
+    def _answer(self, irc, commands, target=None):
+        """Takes a reply from the Bot as the answer to the oldest request for
+        one of commands (for target, if it's known), and records how long it
+        took.  Returns the command that was answered, or None."""
+        state = self._getState(irc)
+        if target is None:
+            keys = [key for key in state.requests if key[0] in commands]
+        else:
+            target = ircutils.toLower(target)
+            keys = [(command, target) for command in commands
+                    if (command, target) in state.requests]
+        if not keys:
+            return None
+        now = time.time()
+        key = min(keys, key=lambda key: state.requests[key].queued)
+        request = state.requests.pop(key)
+        latency = None
+        if request.sent is not None:
+            latency = now - request.sent
+            self._latency(irc.network, key[0]).add(latency)
+        self._event(irc, 'answered', key[1], {'command': key[0],
+                                             'latency': latency})
+        return key[0]
+
+    def _latency(self, network, command):
+        try:
+            return self._latencies[network][command]
+        except KeyError:
+            stats = LatencyStats()
+            self._latencies.setdefault(network, {})[command] = stats
+            return stats
+
+    # How many of the latest timings of each phase of starting up we keep.
+    startupSamples = 100
+
+    def _startupPhase(self, network, phase, elapsed):
+        try:
+            samples = self._startup[network][phase]
+        except KeyError:
+            samples = deque(maxlen=self.startupSamples)
+            self._startup.setdefault(network, {})[phase] = samples
+        samples.append(elapsed)
+
+    def _milestone(self, irc, name, since):
+        """Notes that the connection to irc got to milestone name, and times
+        the phase from milestone since.  Only the first time counts."""
+        startup = self._getState(irc).startup
+        if name not in startup:
+            now = startup[name] = time.time()
+            if since in startup:
+                self._startupPhase(irc.network, name, now - startup[since])
+
+    def _logRepeated(self, irc, level, key, text, s, *args):
+        """Logs s % args at level like self.log does, except that messages
+        with the same key on irc's network are counted rather than logged
+        until the next summary, every repeatInterval seconds."""
+        self._repeats.add(level, irc.network, key, text, s, *args)
+        if self._repeatsEvent is None:
+            def flush():
+                self._repeatsEvent = None
+                self._repeats.flush()
+            delay = self.registryValue('repeatInterval')
+            self._repeatsEvent = schedule.addEvent(flush, time.time() + delay,
+                                                   'NetGamers.repeats')
+
+    def _updateSteady(self, irc):
+        """Works out whether we're identified and on the nick we want, in
+        which case __call__ has nothing to do."""
+        settings = self._getSettings(irc.network)
+        state = self._getState(irc)
+        state.steady = state.identified and \
+            (not settings.useRegged or
+             ircutils.strEqual(settings.reggedNick, irc.nick))
 
     def callCommand(self, command, irc, msg, *args, **kwargs):
         """Make sure we're on an enabled network before proceeding."""
-        if self._isEnabled(irc):
+        # register is how a network gets enabled in the first place.
+        if self._isEnabled(irc) or command[-1] == 'register':
             self.__parent.callCommand(command, irc, msg, *args, **kwargs)
         else:
             self.log.info("Intercepted command %s on %s", command, irc.network)
     
     def outFilter(self, irc, msg):
+        if not self._isEnabled(irc):
+            return msg
+        if not irc.afterConnect and msg.command in ('PASS', 'NICK', 'USER'):
+            return self._registering(irc, msg)
         if msg.command == 'JOIN':
-            if not self.identified:
-                if self.registryValue('noJoinsUntilIdentified'):
-                    self.log.info('Holding JOIN to %s until identified.',
-                                  msg.args[0])
-                    self.waitingJoins.append(msg)
-                    return None
+            return self._planJoin(irc, msg)
         return msg
 
+    def _planJoin(self, irc, msg):
+        """Holds JOINs until we're identified if we need to be, and asks the
+        Bot for an unban or invite instead of JOINing channels we know need
+        one.  Returns what's left of the JOIN."""
+        state = self._getState(irc)
+        waiting = not state.identified and not state.loginFailed
+        holdAll = waiting and \
+                  self._getSettings(irc.network).noJoinsUntilIdentified
+        maxAge = self.registryValue('channelMemory') * 86400
+        channels = msg.args[0].split(',')
+        keys = []
+        if len(msg.args) > 1:
+            keys = msg.args[1].split(',')
+        joining = []
+        for (i, channel) in enumerate(channels):
+            key = i < len(keys) and keys[i] or ''
+            if channel in state.cleared:
+                state.cleared.discard(channel)
+                joining.append((channel, key))
+                continue
+            needs = self._knowledge.needs(irc.network, channel, maxAge)
+            if holdAll or (waiting and 'identify' in needs):
+                self.log.info('Holding JOIN to %s until identified.', channel)
+                self._holdJoin(irc, state, channel, key)
+            elif 'unban' in needs or 'invite' in needs:
+                if 'unban' in needs:
+                    command = 'unban'
+                    self.log.info('Asking Bot to unban us from %s before '
+                                  'joining.', channel)
+                else:
+                    command = 'invite'
+                    self.log.info('Asking Bot to invite us to %s before '
+                                  'joining.', channel)
+                self._botCommand(irc, channel, command, log=True, again=False)
+                request = state.requests.get((command,
+                                              ircutils.toLower(channel)))
+                if request is not None and not request.abandoned:
+                    state.askedJoins[channel] = key
+                else:
+                    # No Bot to ask, or it gave up on us lately; try anyway.
+                    joining.append((channel, key))
+            else:
+                joining.append((channel, key))
+        now = time.time()
+        starting = 'identified' not in state.startup
+        for (channel, key) in joining:
+            # A channel we couldn't get into while starting up still counts
+            # as starting up.
+            (when, wasStarting) = state.joining.get(channel, (now, False))
+            state.joining[channel] = (now, starting or wasStarting)
+        if len(joining) == len(channels):
+            return msg
+        elif joining:
+            keys = [key for (channel, key) in joining if key]
+            return ircmsgs.joins([channel for (channel, key) in joining],
+                                 keys or None)
+        return None
+
+    def _registering(self, irc, msg):
+        """Starts logging in early, as configured by preLogin, when the
+        messages registering us with the server go out."""
+        state = self._getState(irc)
+        if state.registered:
+            # These are for a new connection.
+            state = self._newState(irc)
+        settings = self._getSettings(irc.network)
+        if state.preLogin is not None or settings.preLogin == 'off' or \
+           not settings.reggedNick or not settings.password:
+            return msg
+        if settings.preLogin == 'pass':
+            state.preLogin = 'pass'
+            password = Template(settings.passFormat).safe_substitute(
+                nick=settings.reggedNick, password=settings.password)
+            self.log.info('Logging in with PASS on %s.', irc.network)
+            if msg.command != 'PASS':
+                irc.sendMsg(msg)
+            return ircmsgs.password(password)
+        elif settings.preLogin == 'sasl':
+            if hasattr(irc, 'sasl_authenticated'):
+                # Limnoria negotiates capabilities and SASL itself, and would
+                # answer the server's CAP and AUTHENTICATE along with us.
+                state.preLogin = 'failed'
+                self.log.warning('Not logging in with SASL on %s, which '
+                                 'this bot does itself (see '
+                                 'supybot.networks.%s.sasl); falling back '
+                                 'to LOGIN.', irc.network, irc.network)
+                return msg
+            state.preLogin = 'cap'
+            self.log.info('Requesting SASL on %s.', irc.network)
+            irc.sendMsg(msg)
+            self._saslLater(irc, state)
+            return ircmsgs.IrcMsg(command='CAP', args=('REQ', 'sasl'))
+        return msg
+
+    def _saslLater(self, irc, state):
+        """Arms the timer that gives up on SASL if it isn't over in
+        saslTimeout seconds; the server won't finish registering us until we
+        end the CAP negotiation."""
+        def timeout():
+            state.preLoginEvent = None
+            if self._states.get(irc.network) is state and \
+               state.preLogin in ('cap', 'sasl'):
+                self.log.warning('No answer to SASL on %s.', irc.network)
+                self._endPreLogin(irc, state, False)
+        delay = self.registryValue('saslTimeout')
+        state.preLoginEvent = schedule.addEvent(timeout, time.time() + delay,
+                                                'NetGamers.sasl.%s' %
+                                                irc.network)
+
+    def _endPreLogin(self, irc, state, success):
+        self._removeEvent(state.preLoginEvent)
+        state.preLoginEvent = None
+        if state.preLogin in ('cap', 'sasl'):
+            irc.sendMsg(ircmsgs.IrcMsg(command='CAP', args=('END',)))
+        if success:
+            state.preLogin = 'done'
+        else:
+            state.preLogin = 'failed'
+            self.log.warning('Logging in while connecting failed on %s, '
+                             'falling back to LOGIN.', irc.network)
+        if success:
+            self._identified(irc)
+
+    def doCap(self, irc, msg):
+        state = self._getState(irc)
+        if state.preLogin != 'cap' or len(msg.args) < 3:
+            return
+        if 'sasl' not in msg.args[2].lower().split():
+            return
+        if msg.args[1].upper() == 'ACK':
+            state.preLogin = 'sasl'
+            irc.sendMsg(ircmsgs.IrcMsg(command='AUTHENTICATE',
+                                       args=('PLAIN',)))
+        else:
+            self._endPreLogin(irc, state, False)
+
+    def doAuthenticate(self, irc, msg):
+        state = self._getState(irc)
+        if state.preLogin != 'sasl' or msg.args[0] != '+':
+            return
+        settings = self._getSettings(irc.network)
+        payload = base64.b64encode('\0'.join([settings.reggedNick,
+                                              settings.reggedNick,
+                                              settings.password]))
+        # Sent in chunks of 400, ended by '+' if the last one is full.
+        for i in range(0, len(payload), 400):
+            irc.sendMsg(ircmsgs.IrcMsg(command='AUTHENTICATE',
+                                       args=(payload[i:i+400],)))
+        if len(payload) % 400 == 0:
+            irc.sendMsg(ircmsgs.IrcMsg(command='AUTHENTICATE', args=('+',)))
+
+    def do903(self, irc, msg):
+        # SASL authentication successful.
+        state = self._getState(irc)
+        if state.preLogin == 'sasl':
+            self.log.info('Logged in with SASL on %s.', irc.network)
+            self._endPreLogin(irc, state, True)
+
+    def do904(self, irc, msg):
+        # SASL authentication failed, or aborted, or not possible.
+        state = self._getState(irc)
+        if state.preLogin in ('cap', 'sasl'):
+            self._endPreLogin(irc, state, False)
+    do902 = do905 = do906 = do907 = do908 = do904
+
+    def _holdJoin(self, irc, state, channel, key):
+        if channel in state.waitingJoins:
+            if key:
+                state.waitingJoins[channel] = key
+        elif len(state.waitingJoins) < self.registryValue('maxHeldJoins'):
+            state.waitingJoins[channel] = key
+        else:
+            self.log.warning('Already holding JOINs to %s channels on %s, '
+                             'dropping JOIN to %s.', len(state.waitingJoins),
+                             irc.network, channel)
+
     def _getReggedNick(self, network):
-        return self.registryValue("reggedNick")
+        return self._getSettings(network).reggedNick
 
     def _getReggedPassword(self, network):
-        return self.registryValue("password")
+        return self._getSettings(network).password
 
     def _getUseRegged(self, network):
-        return self.registryValue("useRegged")
+        return self._getSettings(network).useRegged
 
     def _getBotNick(self, network):
-        return self.registryValue('botNick')
+        return self._getSettings(network).botNick
 
-    def isBotNick(self, network, nick):
-        """Compare a nick from a message with the current BotNick.
+    def isBot(self, irc, msg):
+        """Returns whether msg comes from the services Bot.
         
         Bots often have a server appended to their nick for security, so comparing the
         configured nick for the bot with the nick in the message will not always work.
-        This function takes care of testing the possibilities.
+        The BotMatcher takes care of testing the possibilities.
         """
-        botnick = self._getBotNick(network)
-        if botnick and "@" in botnick:
-            botnick, server = botnick.split("@", 1)
-        return botnick and ircutils.strEqual(nick, botnick)
+        state = self._getState(irc)
+        if state.isBot is None:
+            settings = self._getSettings(irc.network)
+            casemapping = irc.state.supported.get('CASEMAPPING', 'rfc1459')
+            host = None
+            if settings.verifyBotHost:
+                host = settings.botHost
+                if not host:
+                    self.log.warning('verifyBotHost is on but botHost isn\'t '
+                                     'set on %s, so nothing is taken as '
+                                     'coming from the Bot.', irc.network)
+                    state.isBot = lambda msg: False
+                    return False
+            state.isBot = BotMatcher(settings.botNick, casemapping, host)
+        return state.isBot(msg)
 
     def _isEnabled(self, irc):
-        enabledNetworks = ("NetGamers",)
-        return irc.network in enabledNetworks or irc.state.supported.get('NETWORK', '') in enabledNetworks
+        """Returns whether the plugin is enabled on irc, working it out once
+        per connection (and again when the server announces its name or the
+        registry changes)."""
+        self._checkRegistry()
+        state = self._getState(irc)
+        if state.enabled is None:
+            networks = self.registryValue('networks')
+            state.enabled = irc.network in networks or \
+                irc.state.supported.get('NETWORK', '') in networks
+            if state.enabled and irc.network not in self._networks:
+                self._registerNetwork(irc.network)
+                self._settings.pop(irc.network, None)
+        return state.enabled
 
     def _doIdentify(self, irc, nick=None):
         if not self._isEnabled(irc):
             return
+        settings = self._getSettings(irc.network)
         if nick is None:
-            nick = self._getReggedNick(irc.network)
-        botnick = self._getBotNick(irc.network)
-        password = self._getReggedPassword(irc.network)
+            nick = settings.reggedNick
+        botnick = settings.botNick
+        password = settings.password
         if not nick or not botnick or not password:
             s = 'Tried to identify without proper configuration.'
             self.log.warning(s)
+            self._loginFailed(irc)
             return
         self.log.info('Sending login (current nick: %s)', irc.nick)
+        self._milestone(irc, 'login', 'motd')
         identify = "LOGIN %s %s" % (nick, password)
-        # It's important that this next statement is irc.sendMsg, not
-        # irc.queueMsg.  We want this message to get through before any
-        # JOIN messages also being sent on 376.
-        irc.sendMsg(ircmsgs.privmsg(botnick, identify))
+        # _sendToBot sends with irc.sendMsg rather than irc.queueMsg, and
+        # LOGIN goes first in the services queue, so this gets through
+        # before any JOIN messages also being sent on 376.
+        self._sendToBot(irc, identify, ('LOGIN', nick))
 
     def _doGhost(self, irc, nick=None):
         if not self._isEnabled(irc):
             return
+        settings = self._getSettings(irc.network)
         if nick is None:
-            nick = self._getReggedNick(irc.network)
-        botnick = self._getBotNick(irc.network)
-        password = self._getReggedPassword(irc.network)
-        ghostDelay = self.registryValue('ghostDelay')
+            nick = settings.reggedNick
+        botnick = settings.botNick
+        password = settings.password
+        ghostDelay = settings.ghostDelay
         if not botnick or not password:
             s = 'Tried to ghost without a BotNick or password set.'
             self.log.warning(s)
             return
-        if self.sentGhost and time.time() < (self.sentGhost + ghostDelay):
+        state = self._getState(irc)
+        if state.sentGhost and time.time() < (state.sentGhost + ghostDelay):
             self.log.warning('Refusing to send RECOVER more than once every '
                              '%s seconds.' % ghostDelay)
         else:
@@ -142,218 +1328,577 @@ class NetGamers(callbacks.Plugin):
                           irc.nick, nick)
             ghost = "RECOVER %s %s %s" % (nick, nick, password)
             # Ditto about the sendMsg (see _doIdentify).
-            irc.sendMsg(ircmsgs.privmsg(botnick, ghost))
-            self.sentGhost = time.time()
+            self._sendToBot(irc, ghost, ('RECOVER', nick))
+            state.sentGhost = time.time()
+            return True
+        return False
+
+    def _reclaim(self, irc):
+        """Starts reclaiming the registered nick, unless we're on it already or
+        an attempt is already outstanding."""
+        state = self._getState(irc)
+        if state.reclaim != IDLE or not irc.afterConnect:
+            return
+        settings = self._getSettings(irc.network)
+        nick = settings.reggedNick
+        if nick and settings.botNick and settings.password:
+            if settings.useRegged and not ircutils.strEqual(nick, irc.nick):
+                online = state.holderOnline
+                if online is None:
+                    if state.watching:
+                        return # The server's answer is on its way.
+                    # All we can go by is whether someone in our channels has
+                    # the nick.
+                    online = nick in irc.state.nicksToHostmasks
+                if online:
+                    self._recover(irc, state)
+                else:
+                    self._requestNick(irc, state)
+
+    def _requestNick(self, irc, state):
+        state.reclaim = NICK_REQUESTED
+        nick = self._getReggedNick(irc.network)
+        irc.sendMsg(ircmsgs.nick(nick)) # 433 is handled elsewhere.
+        self._reclaimLater(irc, state)
+
+    def _recover(self, irc, state):
+        if self._doGhost(irc):
+            state.reclaim = RECOVERING
+        else:
+            state.reclaim = WAITING
+        self._reclaimLater(irc, state)
+
+    def _reclaimLater(self, irc, state):
+        """(Re)arms the timer that tries again if the current attempt gets no
+        answer, backing off exponentially from ghostDelay."""
+        self._removeEvent(state.reclaimEvent)
+        base = self._getSettings(irc.network).ghostDelay
+        delay = min(base * 2 ** state.attempts, base * 64)
+        delay *= random.uniform(1, 1.25)
+        state.attempts += 1
+        def retry():
+            state.reclaimEvent = None
+            if self._states.get(irc.network) is state:
+                state.reclaim = IDLE
+                self._reclaim(irc)
+        state.reclaimEvent = schedule.addEvent(retry, time.time() + delay,
+                                               'NetGamers.reclaim.%s' %
+                                               irc.network)
 
+    def _reclaimed(self, state):
+        self._removeEvent(state.reclaimEvent)
+        state.reclaimEvent = None
+        state.reclaim = IDLE
+        state.attempts = 0
+
+    def _watchNick(self, irc, state):
+        """Asks the server to tell us whether someone is on the registered
+        nick: with MONITOR if it has it, or else with an ISON every
+        watchInterval seconds.  Reclaiming then goes by its answers (see
+        _watched) rather than by whoever happens to share a channel with us."""
+        nick = self._getReggedNick(irc.network)
+        if state.watching or not nick:
+            return
+        if irc.state.supported.get('MONITOR'):
+            state.watching = 'monitor'
+            irc.sendMsg(ircmsgs.IrcMsg(command='MONITOR', args=('+', nick)))
+        else:
+            state.watching = 'ison'
+            self._ison(irc, state)
+
+    def _ison(self, irc, state):
+        settings = self._getSettings(irc.network)
+        if settings.useRegged and settings.reggedNick and \
+           not ircutils.strEqual(settings.reggedNick, irc.nick):
+            irc.sendMsg(ircmsgs.IrcMsg(command='ISON',
+                                       args=(settings.reggedNick,)))
+        self._isonLater(irc, state)
+
+    def _isonLater(self, irc, state):
+        self._removeEvent(state.watchEvent)
+        def ison():
+            state.watchEvent = None
+            if self._states.get(irc.network) is state:
+                self._ison(irc, state)
+        delay = self._getSettings(irc.network).watchInterval
+        state.watchEvent = schedule.addEvent(ison, time.time() + delay,
+                                             'NetGamers.ison.%s' % irc.network)
+
+    def _isReggedNick(self, irc, nicks):
+        nick = self._getReggedNick(irc.network)
+        for other in nicks:
+            if ircutils.strEqual(other, nick):
+                return True
+        return False
+
+    def _watched(self, irc, online):
+        """Takes the server's word on whether someone is on the registered
+        nick, and starts reclaiming it accordingly."""
+        state = self._getState(irc)
+        state.holderOnline = online
+        if not online and state.reclaim != NICK_REQUESTED:
+            # Free now, whatever we were waiting for; take it.
+            state.reclaim = IDLE
+        self._reclaim(irc)
+
+    def do303(self, irc, msg):
+        # RPL_ISON: which of the nicks we asked about are online.
+        if self._getState(irc).watching == 'ison':
+            self._watched(irc, self._isReggedNick(irc, msg.args[-1].split()))
+
+    def do730(self, irc, msg):
+        # RPL_MONONLINE: nick!user@host,...
+        nicks = [s.split('!', 1)[0] for s in msg.args[-1].split(',')]
+        if self._isReggedNick(irc, nicks):
+            self._watched(irc, True)
+
+    def do731(self, irc, msg):
+        # RPL_MONOFFLINE: nick,...
+        if self._isReggedNick(irc, msg.args[-1].split(',')):
+            self._watched(irc, False)
+
+    def do734(self, irc, msg):
+        # ERR_MONLISTFULL; ISON still works.
+        state = self._getState(irc)
+        if state.watching == 'monitor':
+            state.watching = None
+            self.log.info('MONITOR list full on %s, using ISON instead.',
+                          irc.network)
+            self._watchNick(irc, state)
+
+    # The only commands that may get us to start reclaiming the registered
+    # nick; retries are driven by the handlers and _reclaimLater.  PING is in
+    # here so a quiet connection still starts once useRegged is turned on.
+    # Once we're watching the nick, the server tells us when it's free, so
+    # only PING is left.
+    _reclaimCommands = frozenset(['001', '376', '422', '433', '437', 'NICK',
+                                  'QUIT', 'KILL', 'PING'])
+    _watchedCommands = frozenset(['PING'])
     def __call__(self, irc, msg):
+        self._call(irc, msg)
+
+    def _call(self, irc, msg):
+        if msg.command == '005':
+            # ISUPPORT may have told us the network's name or CASEMAPPING.
+            state = self._getState(irc)
+            state.enabled = None
+            state.isBot = None
+            state.modes = None
         if not self._isEnabled(irc):
             return
         self.__parent.__call__(irc, msg)
-        nick = self._getReggedNick(irc.network)
-        botnick = self._getBotNick(irc.network)
-        password = self._getReggedPassword(irc.network)
-        ghostDelay = self.registryValue('ghostDelay')
-        if nick and botnick and password:
-            if self._getUseRegged(irc.network) and not ircutils.strEqual(nick, irc.nick):
-                if irc.afterConnect and (self.sentGhost is None or
-                   (self.sentGhost + ghostDelay) < time.time()):
-                    if nick in irc.state.nicksToHostmasks:
-                        self._doGhost(irc)
-                    else:
-                        irc.sendMsg(ircmsgs.nick(nick)) # 433 is handled elsewhere.
+        state = self._getState(irc)
+        if state.watching:
+            commands = self._watchedCommands
+        else:
+            commands = self._reclaimCommands
+        if state.steady or msg.command not in commands:
+            return
+        if state.reclaim == IDLE:
+            self._reclaim(irc)
 
     def do001(self, irc, msg):
         if not self._isEnabled(irc):
             return
-        # New connection, make sure sentGhost is False.
-        self.sentGhost = None
+        # New connection, start over with a fresh state unless we made one
+        # when we started registering.
+        state = self._getState(irc)
+        if state.registered:
+            state = self._newState(irc)
+        state.registered = True
+        state.startup['connected'] = time.time()
+
+    def doError(self, irc, msg):
+        # The server is closing the connection.
+        self._dropState(irc.network)
 
     def do376(self, irc, msg):
-        nick = self._getReggedNick(irc.network)
+        self._milestone(irc, 'motd', 'connected')
+        settings = self._getSettings(irc.network)
+        nick = settings.reggedNick
         if not nick:
             self.log.warning('Cannot identify without a nick being set.')
             return
-        botnick = self._getBotNick(irc.network)
-        if not botnick:
+        if not settings.botNick:
             self.log.warning('BotNick is unset, cannot identify.')
             return
-        password = self._getReggedPassword(irc.network)
-        if not password:
+        if not settings.password:
             self.log.warning('Password for %s is unset, cannot identify.',nick)
             return
-        if ircutils.strEqual(irc.nick, nick) or self._getUseRegged(irc.network) == False:
-            self._doIdentify(irc)
-        else:
-            self._doGhost(irc)
+        state = self._getState(irc)
+        if state.preLogin in ('cap', 'sasl', 'pass'):
+            # No answer to logging in early; LOGIN the normal way.
+            self._endPreLogin(irc, state, False)
+        self._watchNick(irc, state)
+        if ircutils.strEqual(irc.nick, nick) or settings.useRegged == False:
+            if not state.identified:
+                self._doIdentify(irc)
+        # Otherwise, the answer to MONITOR or ISON tells us whether to RECOVER
+        # the nick or just take it.
     do422 = do377 = do376
 
     def do433(self, irc, msg):
-        nick = self._getReggedNick(irc.network)
-        if nick and irc.afterConnect:
-            password = self._getReggedPassword(irc.network)
-            if not password:
+        settings = self._getSettings(irc.network)
+        if settings.reggedNick and irc.afterConnect:
+            if not settings.password:
                 return
-            self._doGhost(irc)
+            state = self._getState(irc)
+            if state.reclaim in (IDLE, NICK_REQUESTED):
+                self._recover(irc, state)
 
     def do515(self, irc, msg):
         # Can't join this channel, it's +r (we must be identified).
-        self.channels.append(msg.args[1])
+        channel = msg.args[1]
+        self._learn(irc, channel, 'identify')
+        networkGroup = conf.supybot.networks.get(irc.network)
+        key = networkGroup.channels.key.get(channel)()
+        self._holdJoin(irc, self._getState(irc), channel, key)
 
     def doNick(self, irc, msg):
         nick = self._getReggedNick(irc.network)
+        state = self._getState(irc)
+        if ircutils.strEqual(msg.args[0], irc.nick):
+            self._updateSteady(irc)
         if nick:
             if ircutils.strEqual(msg.args[0], irc.nick) and ircutils.strEqual(irc.nick, nick):
-                self._doIdentify(irc)
+                self._reclaimed(state)
+                if not state.identified:
+                    self._doIdentify(irc)
             elif ircutils.strEqual(msg.nick, nick):
-                irc.sendMsg(ircmsgs.nick(nick))
-
-    def _ghosted(self, network, s):
-        nick = self._getReggedNick(network)
-        lowered = s.lower()
-        return bool('killed' in lowered and (nick in s or 'ghost' in lowered))
+                # Whoever had our nick just left it.
+                if state.reclaim != NICK_REQUESTED and \
+                   self._getUseRegged(irc.network):
+                    self._requestNick(irc, state)
 
     def doNotice(self, irc, msg):
         if not self._isEnabled(irc):
             return
-        if irc.afterConnect:
-            botnick = self._getBotNick(irc.network)
-            if botnick and self.isBotNick(irc.network, msg.nick):
-                handled = self.doChanservNotice(irc, msg)
+        if irc.afterConnect or self._getState(irc).preLogin == 'pass':
+            if self.isBot(irc, msg):
+                classifier = self._getSettings(irc.network).classifier
+                notice = classifier.classify(msg.args[1])
+                self._event(irc, notice.event or 'unexpected', notice.target,
+                            msg.args[1][:200])
+                if self.doThrottledNotice(irc, msg, notice):
+                    return
+                self._getState(irc).queue.recover()
+                handled = self.doChanservNotice(irc, msg, notice)
                 if not handled:
-                    handled = self.doNickservNotice(irc, msg)
+                    handled = self.doNickservNotice(irc, msg, notice)
                 if not handled:
                     on = 'on %s' % irc.network
-                    s = ircutils.stripFormatting(msg.args[1].lower())
-                    self.log.warning('Unexpected notice from Bot %s: %r.', on, s)
+                    self._logRepeated(irc, 'warning',
+                                      self._repeats.normalize(notice.text),
+                                      notice.text,
+                                      'Unexpected notice from Bot %s: %r.',
+                                      on, notice.text)
+                    if self._stats is not None:
+                        self._stats.count(irc.network, 'unexpected notices')
 
-    _chanRe = re.compile('\x02(.*?)\x02')
-    def doChanservNotice(self, irc, msg):
-        s = ircutils.stripFormatting(msg.args[1].lower())
-        channel = None
-        m = self._chanRe.search(s)
-        networkGroup = conf.supybot.networks.get(irc.network)
+    def doThrottledNotice(self, irc, msg, notice):
+        if notice.event != 'throttled':
+            return False
+        queue = self._getState(irc).queue
+        queue.throttle()
+        self.log.warning('Bot says we\'re too fast on %s, slowing down to '
+                         '%.2f messages a second.', irc.network, queue.rate)
+        return True
+
+    _channelCommands = ('op', 'halfop', 'voice', 'unban', 'invite')
+
+    def doChanservNotice(self, irc, msg, notice):
+        event = notice.event
+        channel = notice.target
         on = 'on %s' % irc.network
-        if m is not None:
-            channel = m.group(1)
-        if 'all bans' in s or 'unbanned from' in s:
+        if event == 'unbanned':
             # All bans removed (freenode)
             # You have been unbanned from (oftc)
-            irc.sendMsg(networkGroup.channels.join(channel))
-        elif 'isn\'t registered' in s:
-            self.log.warning('Received "%s isn\'t registered" from Bot %', channel, on)
-        elif 'this channel has been registered' in s:
+            self._answer(irc, ('unban',), channel)
+            if channel:
+                self._getState(irc).helped.add(channel)
+                irc.sendMsg(self._clearedJoin(irc, channel))
+        elif event == 'channelNotRegistered':
+            self._refused(irc, channel)
+            self._logRepeated(irc, 'warning', event, notice.text,
+                              'Received "%s isn\'t registered" from Bot %s.',
+                              channel, on)
+        elif event == 'channelRegistered':
             self.log.debug('Got "Registered channel" from Bot %s.', on)
-        elif 'already opped' in s:
+        elif event == 'alreadyOpped':
             # This shouldn't happen, NetGamers.op should refuse to run if
             # we already have ops.
             self.log.debug('Got "Already opped" from Bot %s.', on)
-        elif 'access level' in s and 'is required' in s:
-            self.log.warning('Got "Access level required" from Bot %s.', on)
-        elif 'insufficient access' in s:
-            self.log.warning('Got "insufficient access" from Bot %s.', on)
-        elif 'inviting' in s:
+            self._answer(irc, ('op',), channel)
+        elif event == 'accessRequired':
+            self._logRepeated(irc, 'warning', event, notice.text,
+                              'Got "Access level required" from Bot %s.', on)
+            self._refused(irc, channel)
+        elif event == 'insufficientAccess':
+            self._logRepeated(irc, 'warning', event, notice.text,
+                              'Got "insufficient access" from Bot %s.', on)
+            self._refused(irc, channel)
+        elif event == 'inviting':
             self.log.debug('Got "Inviting to channel" from Bot %s.', on)
+            self._answer(irc, ('invite',), channel)
         else:
             return False # Notice not handled as channel related 
         return True
 
-    def doNickservNotice(self, irc, msg):
-        nick = self._getReggedNick(irc.network)
-        s = ircutils.stripFormatting(msg.args[1].lower())
+    def _refused(self, irc, channel):
+        """Takes a refusal from the Bot as the answer to a request about
+        channel, and JOINs anyway if it was an unban or invite we asked for
+        instead of JOINing."""
+        command = self._answer(irc, self._channelCommands, channel)
+        if command in ('unban', 'invite') and channel:
+            self._joinAnyway(irc, self._getState(irc), channel)
+
+    def _joinAnyway(self, irc, state, channel):
+        """Sends the JOIN to channel _planJoin held back for an unban or
+        invite the Bot won't give us, if there was one; the channel might let
+        us in regardless, and if it doesn't, we'll hear why."""
+        if channel in state.askedJoins:
+            self.log.info('Joining %s on %s without the Bot\'s help.',
+                          channel, irc.network)
+            irc.sendMsg(self._clearedJoin(irc, channel))
+
+    def _clearedJoin(self, irc, channel):
+        """Returns the JOIN to channel that _planJoin is to let through: the
+        one it held back for the Bot, or the configured one."""
+        state = self._getState(irc)
+        state.cleared.add(channel)
+        try:
+            key = state.askedJoins.pop(channel)
+        except KeyError:
+            return conf.supybot.networks.get(irc.network).channels.join(channel)
+        if key:
+            return ircmsgs.join(channel, key)
+        return ircmsgs.join(channel)
+
+    def doNickservNotice(self, irc, msg, notice):
+        event = notice.event
         on = 'on %s' % irc.network
-        networkGroup = conf.supybot.networks.get(irc.network)
-        if ('incorrect' in s) or \
-           ('denied' in s) or \
-           ('authentication failed' in s) or \
-           ('unable to authenticate' in s):
+        state = self._getState(irc)
+        if event == 'passwordIncorrect':
             self.log.warning('Received "Password Incorrect" from Bot %s.' % on)
-            self.sentGhost = time.time()
-        elif self._ghosted(irc.network, s):
+            self._answer(irc, ('LOGIN', 'RECOVER'))
+            self._loginFailed(irc)
+            state.sentGhost = time.time()
+            if state.reclaim != IDLE:
+                state.reclaim = WAITING
+        elif event == 'ghosted':
             self.log.info('Received "GHOST succeeded" from Bot %s.', on)
-            self.sentGhost = None
-            self.identified = False
-            irc.queueMsg(ircmsgs.nick(nick))
-        elif 'is not registered' in s or 'don\'t know who' in s:
+            self._answer(irc, ('RECOVER',), notice.target)
+            state.sentGhost = None
+            state.identified = False
+            state.steady = False
+            if state.reclaim != NICK_REQUESTED:
+                self._requestNick(irc, state)
+        elif event == 'nickNotRegistered':
             self.log.info('Received "Nick not registered" from Bot %s.', on)
-        elif 'currently' in s and 'isn\'t' in s or 'is not' in s:
+            self._answer(irc, ('LOGIN', 'RECOVER'))
+            self._loginFailed(irc)
+        elif event == 'nickOffline':
             # The nick isn't online, let's change our nick to it.
-            self.sentGhost = None
-            irc.queueMsg(ircmsgs.nick(nick))
-        elif ('owned by someone else' in s) or \
-             ('nickname is registered and protected' in s) or \
-             ('nick belongs to another user' in s):
+            self._answer(irc, ('RECOVER',))
+            state.sentGhost = None
+            if state.reclaim != NICK_REQUESTED:
+                self._requestNick(irc, state)
+        elif event == 'nickRegistered':
             self.log.info('Received "Registered nick" from Bot %s.', on)
-        elif ('now recognized' in s) or \
-             ('already identified' in s) or \
-             ('password accepted' in s) or \
-             ('now identified' in s) or \
-             ('authentication successful' in s) or \
-             ('already authenticated' in s):
+        elif event == 'accepted':
             self.log.info('Received "Password accepted" from Bot %s.', on)
-            self.identified = True
-            for channel in irc.state.channels.keys():
-                self.checkPrivileges(irc, channel)
-            for channel in self.channels:
-                irc.queueMsg(networkGroup.channels.join(channel))
-            if self.waitingJoins:
-                for m in self.waitingJoins:
-                    irc.sendMsg(m)
-                self.waitingJoins = []
-        elif ('motd' in s):
+            self._answer(irc, ('LOGIN',))
+            if state.preLogin == 'pass':
+                state.preLogin = 'done'
+            self._identified(irc)
+        elif event == 'motd':
             # MOTD from Bot, just ignore it
             pass
         else:
             return False # Notice not handled as nick related
         return True
 
-    def checkPrivileges(self, irc, channel):
+    def _identified(self, irc):
+        state = self._getState(irc)
+        state.identified = True
+        self._milestone(irc, 'identified', 'login')
+        self._updateSteady(irc)
+        for (channel, deficit) in self._getDeficits(irc, state).items():
+            self._requestPrivileges(irc, channel, deficit)
+        if state.waitingJoins:
+            self._milestone(irc, 'joins', 'identified')
+            self._sendHeldJoins(irc, state)
+
+    def _loginFailed(self, irc):
+        """Stops holding JOINs for a login that failed or can't happen, and
+        sends the ones held so far."""
+        state = self._getState(irc)
+        if state.identified:
+            return
+        state.loginFailed = True
+        if state.waitingJoins:
+            self.log.warning('Not logged in on %s, joining the %s channels '
+                             'held for it anyway.', irc.network,
+                             len(state.waitingJoins))
+            self._sendHeldJoins(irc, state)
+
+    def _sendHeldJoins(self, irc, state):
+        now = time.time()
+        for channel in state.waitingJoins:
+            state.joining[channel] = (now, True)
+        for m in joins(state.waitingJoins.items()):
+            irc.sendMsg(m)
+        state.waitingJoins.clear()
+
+    def _requestPrivileges(self, irc, channel, deficit):
         botnick = self._getBotNick(irc.network)
+        if not botnick:
+            return
         on = 'on %s' % irc.network
-        if botnick and self.registryValue('op', channel):
-            if irc.nick not in irc.state.channels[channel].ops:
-                self.log.info('Requesting op from %s in %s %s.',
-                              botnick, channel, on)
-                irc.sendMsg(ircmsgs.privmsg(botnick, 'op %s' % channel))
-        if botnick and self.registryValue('halfop', channel):
-            if irc.nick not in irc.state.channels[channel].halfops:
-                self.log.info('Requesting halfop from %s in %s %s.',
-                              botnick, channel, on)
-                irc.sendMsg(ircmsgs.privmsg(botnick, 'halfop %s' % channel))
-        if botnick and self.registryValue('voice', channel):
-            if irc.nick not in irc.state.channels[channel].voices:
-                self.log.info('Requesting voice from %s in %s %s.',
-                              botnick, channel, on)
-                irc.sendMsg(ircmsgs.privmsg(botnick, 'voice %s' % channel))
+        for privilege in deficit:
+            self.log.info('Requesting %s from %s in %s %s.',
+                          privilege, botnick, channel, on)
+            self._sendToBot(irc, '%s %s' % (privilege, channel),
+                            (privilege, channel))
+
+    # The privileges we may ask for, highest first, with the ChannelState
+    # attribute holding who has each.
+    _privileges = (('op', 'ops'), ('halfop', 'halfops'), ('voice', 'voices'))
+
+    def _deficit(self, irc, channel):
+        """Returns the privileges we want in channel but don't have, leaving
+        out those a privilege we already have covers (no voice when we're
+        opped)."""
+        try:
+            chanState = irc.state.channels[channel]
+        except KeyError:
+            return ()
+        deficit = []
+        for (privilege, holders) in self._privileges:
+            if irc.nick in getattr(chanState, holders):
+                break
+            if self.registryValue(privilege, channel):
+                deficit.append(privilege)
+        return tuple(deficit)
+
+    def _updateDeficit(self, irc, channel):
+        """Works out channel's deficit again, keeps the index up to date and
+        returns it."""
+        deficit = self._deficit(irc, channel)
+        deficits = self._getState(irc).deficits
+        if deficits is not None:
+            if deficit:
+                deficits[channel] = deficit
+            else:
+                deficits.pop(channel, None)
+        return deficit
+
+    def _getDeficits(self, irc, state):
+        """Returns the index of channels we lack privileges in, rebuilding it
+        from every channel if the registry changed since it was built."""
+        self._checkRegistry()
+        if state.deficits is None:
+            state.deficits = ircutils.IrcDict()
+            for channel in irc.state.channels:
+                self._updateDeficit(irc, channel)
+        return state.deficits
+
+    # The modes for the privileges we track.
+    _privilegeModes = {'o': 'op', 'h': 'halfop', 'v': 'voice'}
 
     def doMode(self, irc, msg):
         if not self._isEnabled(irc):
             return
+        channel = msg.args[0]
+        if not ircutils.isChannel(channel) or len(msg.args) < 3:
+            return
+        # Most MODEs, and nearly all of a flood after a netsplit, aren't about
+        # us; don't bother parsing those.
+        nick = ircutils.toLower(irc.nick)
+        for arg in msg.args[2:]:
+            if ircutils.toLower(arg) == nick:
+                break
+        else:
+            return
+        state = self._getState(irc)
+        if state.modes is None:
+            supported = irc.state.supported
+            state.modes = ModeParser(supported.get('PREFIX'),
+                                     supported.get('CHANMODES'))
+        fromBot = self.isBot(irc, msg)
         on = 'on %s' % irc.network
-        if self.isBotNick(irc.network, msg.nick):
-            channel = msg.args[0]
-            if len(msg.args) == 3:
-                if ircutils.strEqual(msg.args[2], irc.nick):
-                    mode = msg.args[1]
-                    info = self.log.info
-                    if mode == '+o':
-                        info('Received op from Bot in %s %s.', channel, on)
-                    elif mode == '+h':
-                        info('Received halfop from Bot in %s %s.', channel, on)
-                    elif mode == '+v':
-                        info('Received voice from Bot in %s %s.', channel, on)
+        lost = False
+        for (sign, mode, arg) in state.modes.parse(msg.args[1:]):
+            privilege = self._privilegeModes.get(mode)
+            if privilege is None or arg is None or \
+               ircutils.toLower(arg) != nick:
+                continue
+            self._event(irc, 'mode', channel, sign + mode)
+            if sign == '-':
+                self.log.info('Lost %s in %s %s (%s).',
+                              privilege, channel, on, msg.nick)
+                lost = lost or not fromBot
+            else:
+                self._gotPrivilege(irc, state, channel)
+                if fromBot:
+                    self.log.info('Received %s from Bot in %s %s.',
+                                  privilege, channel, on)
+                    self._answer(irc, (privilege,), channel)
+        deficit = self._updateDeficit(irc, channel)
+        if lost and deficit and state.identified:
+            # Somebody took a privilege we want; ask for it back.
+            self._requestPrivileges(irc, channel, deficit)
+
+    def _gotPrivilege(self, irc, state, channel):
+        """Times how long we took to get op or voice in channel, from the end
+        of its NAMES and, if we joined it while starting up, from 001."""
+        try:
+            (when, starting) = state.joined.pop(channel)
+        except KeyError:
+            return
+        now = time.time()
+        self._startupPhase(irc.network, 'op', now - when)
+        if starting and 'connected' in state.startup:
+            self._startupPhase(irc.network, 'total',
+                               now - state.startup['connected'])
 
     def do366(self, irc, msg): # End of /NAMES list; finished joining a channel
-        if self.identified:
-            channel = msg.args[1] # nick is msg.args[0].
-            self.checkPrivileges(irc, channel)
+        channel = msg.args[1] # nick is msg.args[0].
+        state = self._getState(irc)
+        try:
+            (when, starting) = state.joining.pop(channel)
+        except KeyError:
+            pass
+        else:
+            now = time.time()
+            self._startupPhase(irc.network, 'names', now - when)
+            state.joined[channel] = (now, starting)
+        deficit = self._updateDeficit(irc, channel)
+        if self._getState(irc).identified:
+            self._requestPrivileges(irc, channel, deficit)
 
-    def _botCommand(self, irc, channel, command, log=False):
+    def doPart(self, irc, msg):
+        if ircutils.strEqual(msg.nick, irc.nick):
+            state = self._getState(irc)
+            for channel in msg.args[0].split(','):
+                state.joined.pop(channel, None)
+                if state.deficits is not None:
+                    state.deficits.pop(channel, None)
+
+    def doKick(self, irc, msg):
+        if ircutils.strEqual(msg.args[1], irc.nick):
+            state = self._getState(irc)
+            state.joined.pop(msg.args[0], None)
+            if state.deficits is not None:
+                state.deficits.pop(msg.args[0], None)
+
+    def _botCommand(self, irc, channel, command, log=False, again=True):
         if not self._isEnabled(irc):
             return
         botnick = self._getBotNick(irc.network)
         if botnick:
-            msg = ircmsgs.privmsg(botnick, ' '.join([command, channel, irc.nick]))
-            irc.sendMsg(msg)
+            self._sendToBot(irc, ' '.join([command, channel, irc.nick]),
+                            (command, channel), again)
         else:
             if log:
                 self.log.warning('Unable to send %s command to Bot, '
@@ -364,80 +1909,227 @@ class NetGamers(callbacks.Plugin):
                                  'I can send commands to Bot.', irc.network, command,
                           Raise=True)
 
-    def op(self, irc, msg, args, channel):
-        """[<channel>]
+    def _has(self, irc, channel, command):
+        """Returns whether we already have what command would get us in
+        channel: the privilege or a higher one, or for invite, being in it.
+        For unban, we can't tell."""
+        if command == 'invite':
+            return channel in irc.state.channels
+        elif command == 'unban':
+            return False
+        chanState = irc.state.channels[channel]
+        for (privilege, holders) in self._privileges:
+            if irc.nick in getattr(chanState, holders):
+                return True
+            if privilege == command:
+                return False
 
-        Attempts to get opped by Bot in <channel>.  <channel> is only
-        necessary if the message isn't sent in the channel itself.
-        """
-        if irc.nick in irc.state.channels[channel].ops:
-            irc.error(format('I\'m already opped in %s.', channel))
+    def _expandChannels(self, irc, msg, patterns, command):
+        """Returns the channels patterns name, in order and without repeats;
+        a glob matches the channels we're in, and for unban and invite, the
+        ones we're configured to join as well."""
+        if not patterns:
+            if not ircutils.isChannel(msg.args[0]):
+                irc.error('Give me a channel or a glob, or use this command '
+                          'in a channel.', Raise=True)
+            patterns = [msg.args[0]]
+        candidates = list(irc.state.channels)
+        if command in ('unban', 'invite'):
+            networkGroup = conf.supybot.networks.get(irc.network)
+            candidates.extend(networkGroup.channels())
+        channels = []
+        seen = ircutils.IrcSet()
+        for pattern in patterns:
+            if '*' in pattern or '?' in pattern:
+                pattern = ircutils.toLower(pattern)
+                matches = [channel for channel in candidates
+                           if fnmatch.fnmatchcase(ircutils.toLower(channel),
+                                                  pattern)]
+            elif ircutils.isChannel(pattern):
+                matches = [pattern]
+            else:
+                irc.errorInvalid('channel', pattern, Raise=True)
+            for channel in matches:
+                if channel not in seen:
+                    seen.add(channel)
+                    channels.append(channel)
+        return channels
+
+    def _mayAsk(self, msg, channel):
+        """Returns whether the user sending msg has admin, or op in channel,
+        as a capability of their own; the defaults that let anyone through
+        don't count."""
+        try:
+            user = ircdb.users.getUser(msg.prefix)
+        except (KeyError, ValueError):
+            return False
+        op = ircdb.makeChannelCapability(channel, 'op')
+        for capability in ('admin', op):
+            try:
+                if user.capabilities.check(capability):
+                    return True
+            except KeyError:
+                pass
+        return False
+
+    _bulkDone = {'op': 'already opped', 'halfop': 'already halfopped',
+                 'voice': 'already voiced', 'invite': 'already'}
+    def _bulkCommand(self, irc, msg, patterns, command):
+        """Asks the Bot for command in every channel patterns name (see
+        _expandChannels) that the user may ask for it in and we don't already
+        have it in, and replies once with how that went.  For one channel,
+        the op capability there will do; for a glob or several channels, the
+        user needs a capability of their own (see _mayAsk), and isn't told
+        which channels they were turned down in.  The requests go through
+        the services queue, so they're paced like any others."""
+        if not self._getBotNick(irc.network):
+            irc.error('You must set supybot.plugins.NetGamers.%s.botNick '
+                      'before I can send commands to Bot.' % irc.network,
+                      Raise=True)
+        inChannel = command not in ('unban', 'invite')
+        bulk = len(patterns) > 1 or \
+               [p for p in patterns if '*' in p or '?' in p]
+        (sent, already, notIn, denied) = ([], [], [], [])
+        for channel in self._expandChannels(irc, msg, patterns, command):
+            capability = ircdb.makeChannelCapability(channel, 'op')
+            if bulk and not self._mayAsk(msg, channel):
+                denied.append(channel)
+            elif not ircdb.checkCapability(msg.prefix, capability):
+                denied.append(channel)
+            elif inChannel and channel not in irc.state.channels:
+                notIn.append(channel)
+            elif self._has(irc, channel, command):
+                already.append(channel)
+            else:
+                self._sendToBot(irc, ' '.join([command, channel, irc.nick]),
+                                (command, channel), flush=False)
+                sent.append(channel)
+        if sent:
+            self._flushQueue(irc, self._getState(irc))
+        def some(channels):
+            if len(channels) > 5:
+                return format('%n', (len(channels), 'channel'))
+            return format('%L', channels)
+        L = []
+        if sent:
+            L.append('Asked Bot for %s in %s' % (command, some(sent)))
+        if already:
+            L.append('%s in %s' % (self._bulkDone[command], some(already)))
+        if notIn:
+            L.append('not in %s' % some(notIn))
+        if denied and bulk:
+            L.append(format('you need the admin capability, or op in the '
+                            'channel, for %n', (len(denied), 'channel')))
+        elif denied:
+            L.append('you lack the op capability in %s' % some(denied))
+        s = '; '.join(L) + '.'
+        if not L:
+            irc.error('No channels match.')
+        elif not sent:
+            irc.error(s[0].upper() + s[1:])
         else:
-            self._botCommand(irc, channel, 'op')
-    op = wrap(op, [('checkChannelCapability', 'op'), 'inChannel'])
+            irc.reply(s)
 
-    def voice(self, irc, msg, args, channel):
-        """[<channel>]
+    def op(self, irc, msg, args, patterns):
+        """[<channel|glob> ...]
 
-        Attempts to get voiced by Bot in <channel>.  <channel> is only
-        necessary if the message isn't sent in the channel itself.
+        Attempts to get opped by Bot in each <channel>, or each channel we're
+        in matching <glob> (#team-*, or * for all of them), skipping those
+        we're opped in already.  Defaults to the current channel.
         """
-        if irc.nick in irc.state.channels[channel].voices:
-            irc.error(format('I\'m already voiced in %s.', channel))
-        else:
-            self._botCommand(irc, channel, 'voice')
-    voice = wrap(voice, [('checkChannelCapability', 'op'), 'inChannel'])
+        self._bulkCommand(irc, msg, patterns, 'op')
+    op = wrap(op, [any('somethingWithoutSpaces')])
+
+    def halfop(self, irc, msg, args, patterns):
+        """[<channel|glob> ...]
+
+        Attempts to get halfopped by Bot in each <channel>, or each channel
+        we're in matching <glob>, skipping those we're halfopped or opped in
+        already.  Defaults to the current channel.
+        """
+        self._bulkCommand(irc, msg, patterns, 'halfop')
+    halfop = wrap(halfop, [any('somethingWithoutSpaces')])
+
+    def voice(self, irc, msg, args, patterns):
+        """[<channel|glob> ...]
+
+        Attempts to get voiced by Bot in each <channel>, or each channel we're
+        in matching <glob>, skipping those we're voiced (or better) in
+        already.  Defaults to the current channel.
+        """
+        self._bulkCommand(irc, msg, patterns, 'voice')
+    voice = wrap(voice, [any('somethingWithoutSpaces')])
 
     def do474(self, irc, msg):
         channel = msg.args[1]
         on = 'on %s' % irc.network
         self.log.info('Banned from %s, attempting Bot unban %s.', channel, on)
-        self._botCommand(irc, channel, 'unban', log=True)
+        self._learn(irc, channel, 'unban')
+        self._botCommand(irc, channel, 'unban', log=True, again=False)
         # Success log in doChanservNotice.
 
-    def unban(self, irc, msg, args, channel):
-        """[<channel>]
+    def unban(self, irc, msg, args, patterns):
+        """[<channel|glob> ...]
 
-        Attempts to get unbanned by Bot in <channel>.  <channel> is only
+        Attempts to get unbanned by Bot in each <channel>, or each channel
+        we're in or configured to join matching <glob>.  <channel> is only
         necessary if the message isn't sent in the channel itself, but chances
         are, if you need this command, you're not sending it in the channel
         itself.
         """
-        self._botCommand(irc, channel, 'unban')
-        irc.replySuccess()
-    unban = wrap(unban, [('checkChannelCapability', 'op')])
+        self._bulkCommand(irc, msg, patterns, 'unban')
+    unban = wrap(unban, [any('somethingWithoutSpaces')])
 
     def do473(self, irc, msg):
         channel = msg.args[1]
         on = 'on %s' % irc.network
         self.log.info('%s is +i, attempting Bot invite %s.', channel, on)
-        self._botCommand(irc, channel, 'invite', log=True)
+        self._learn(irc, channel, 'invite')
+        self._botCommand(irc, channel, 'invite', log=True, again=False)
 
     def do475(self, irc, msg):
         channel = msg.args[1]
         on = 'on %s' % irc.network
         self.log.info('%s is +k, attempting Bot invite to get around %s.', channel, on)
-        self._botCommand(irc, channel, 'invite', log=True)
+        # Not learned: an invite only helps until the key is fixed, and the
+        # key is what the config should have.
+        self._botCommand(irc, channel, 'invite', log=True, again=False)
 
-    def invite(self, irc, msg, args, channel):
-        """[<channel>]
+    def invite(self, irc, msg, args, patterns):
+        """[<channel|glob> ...]
 
-        Attempts to get invited by Bot to <channel>.  <channel> is only
-        necessary if the message isn't sent in the channel itself, but chances
-        are, if you need this command, you're not sending it in the channel
-        itself.
+        Attempts to get invited by Bot to each <channel>, or each channel
+        we're configured to join matching <glob>, skipping those we're in
+        already.  <channel> is only necessary if the message isn't sent in the
+        channel itself, but chances are, if you need this command, you're not
+        sending it in the channel itself.
         """
-        self._botCommand(irc, channel, 'invite')
-        irc.replySuccess()
-    invite = wrap(invite, [('checkChannelCapability', 'op'), 'inChannel'])
+        self._bulkCommand(irc, msg, patterns, 'invite')
+    invite = wrap(invite, [any('somethingWithoutSpaces')])
 
     def doInvite(self, irc, msg):
-        if self.isBotNick(irc.network, msg.nick):
+        if self.isBot(irc, msg):
             channel = msg.args[1]
             on = 'on %s' % irc.network
-            networkGroup = conf.supybot.networks.get(irc.network)
             self.log.info('Joining %s, invited by Bot %s.', channel, on)
-            irc.queueMsg(networkGroup.channels.join(channel))
+            self._event(irc, 'invited', channel)
+            self._answer(irc, ('invite',), channel)
+            self._getState(irc).helped.add(channel)
+            irc.queueMsg(self._clearedJoin(irc, channel))
+
+    def doJoin(self, irc, msg):
+        if ircutils.strEqual(msg.nick, irc.nick):
+            # Forget what this shows these channels don't need.
+            state = self._getState(irc)
+            for channel in msg.args[0].split(','):
+                state.askedJoins.pop(channel, None)
+                if not state.identified:
+                    self._knowledge.forget(irc.network, channel, 'identify')
+                if channel in state.helped:
+                    state.helped.discard(channel)
+                else:
+                    self._knowledge.forget(irc.network, channel, 'invite')
+                    self._knowledge.forget(irc.network, channel, 'unban')
 
     def identify(self, irc, msg, args):
         """takes no arguments
@@ -481,12 +2173,176 @@ class NetGamers(callbacks.Plugin):
         
         Enables the NetGamers plugin for this network with the given nicks and password.
         """
-        config.registerVariable(irc.network, "botNick", botNick)
-        config.registerVariable(irc.network, "reggedNick", reggedNick)
-        config.registerVariable(irc.network, "password", password, True)
+        group = self._registerNetwork(irc.network)
+        group.botNick.setValue(botNick)
+        group.reggedNick.setValue(reggedNick)
+        group.password.setValue(password)
+        networks = conf.supybot.plugins.NetGamers.networks
+        if irc.network not in networks():
+            networks.setValue(networks() | set([irc.network]))
         irc.replySuccess()
     register = wrap(register, [('checkCapability', 'admin'), "somethingWithoutSpaces", "nick", "text"])
 
+    def stats(self, irc, msg, args, optlist, network):
+        """[--reset] [<network>]
+
+        Shows how often and how fast the plugin's message handlers have run
+        on <network>, which defaults to the current network.  With --reset,
+        starts counting over on <network> afterwards.  Requires
+        supybot.plugins.NetGamers.collectStats to be on.
+        """
+        if self._stats is None:
+            irc.error('I\'m not collecting stats; turn on '
+                      'supybot.plugins.NetGamers.collectStats first.')
+            return
+        reset = False
+        for (option, arg) in optlist:
+            if option == 'reset':
+                reset = True
+        if not network:
+            network = irc.network
+        (since, handlers, counters) = self._stats.snapshot(network, reset)
+        L = []
+        for (name, stats) in sorted(handlers.iteritems()):
+            p90 = stats.percentile(0.9)
+            if p90 is None:
+                p90 = 'over %sms' % (stats.bounds[-1] * 1000)
+            else:
+                p90 = 'under %sus' % int(p90 * 1000000)
+            L.append('%s: %s calls, %.3fs total, %.1fus average, 90%% %s' %
+                     (name, stats.calls, stats.total,
+                      stats.total / stats.calls * 1000000, p90))
+        for (name, count) in sorted(counters.iteritems()):
+            L.append('%s: %s' % (name, count))
+        if not L:
+            irc.reply('Nothing recorded on %s since %s.' %
+                      (network, time.ctime(since)))
+        else:
+            irc.reply('Since %s on %s: %s' %
+                      (time.ctime(since), network, '; '.join(L)))
+    stats = wrap(stats, [('checkCapability', 'admin'),
+                         getopts({'reset': ''}), additional('something')])
+
+    def latency(self, irc, msg, args, optlist, network):
+        """[--reset] [<network>]
+
+        Shows how long the services Bot on <network>, which defaults to the
+        current network, has taken to answer each kind of command, and how
+        many commands it never answered.  With --reset, starts counting over
+        afterwards.
+        """
+        if not network:
+            network = irc.network
+        latencies = self._latencies.get(network, {})
+        for (option, arg) in optlist:
+            if option == 'reset':
+                self._latencies.pop(network, None)
+        L = []
+        for (command, stats) in sorted(latencies.iteritems()):
+            if stats.calls:
+                L.append('%s: %s answered, %.2fs average, 50%% %s, 90%% %s, '
+                         '%s unanswered' %
+                         (command, stats.calls, stats.total / stats.calls,
+                          stats.bound(0.5), stats.bound(0.9),
+                          stats.timeouts))
+            else:
+                L.append('%s: %s unanswered' % (command, stats.timeouts))
+        if not L:
+            irc.reply('Nothing sent to the Bot on %s yet.' % network)
+        else:
+            irc.reply('; '.join(L))
+    latency = wrap(latency, [('checkCapability', 'admin'),
+                             getopts({'reset': ''}), additional('something')])
+
+    # The phases of starting up, in order, as the startup command shows them.
+    _startupPhases = ['motd', 'login', 'identified', 'joins', 'names', 'op',
+                      'total']
+
+    def startup(self, irc, msg, args, optlist, network):
+        """[--reset] [<network>]
+
+        Shows how long the latest connections to <network>, which defaults to
+        the current network, took to become useful: from 001 to the end of the
+        MOTD (motd), from there to sending LOGIN (login), to the Bot accepting
+        it (identified) and to the held JOINs going out (joins); and for each
+        channel, from the JOIN to the end of NAMES (names), from there to
+        getting op or voice (op), and from 001 to getting op or voice in the
+        channels joined while starting up (total).  With --reset, starts
+        counting over afterwards.
+        """
+        if not network:
+            network = irc.network
+        phases = self._startup.get(network, {})
+        for (option, arg) in optlist:
+            if option == 'reset':
+                self._startup.pop(network, None)
+        L = []
+        for phase in self._startupPhases:
+            samples = phases.get(phase)
+            if not samples:
+                continue
+            stats = StartupStats()
+            for elapsed in samples:
+                stats.add(elapsed)
+            L.append('%s: %s timed, %.2fs average, 50%% %s, 90%% %s, '
+                     '%.2fs max' %
+                     (phase, stats.calls, stats.total / stats.calls,
+                      stats.bound(0.5), stats.bound(0.9), max(samples)))
+        if not L:
+            irc.reply('Nothing timed on %s yet.' % network)
+        else:
+            irc.reply('; '.join(L))
+    startup = wrap(startup, [('checkCapability', 'admin'),
+                             getopts({'reset': ''}), additional('something')])
+
+    def events(self, irc, msg, args, optlist):
+        """[--network <network>] [--event <event>] [--target <channel|nick>] \
+        [--since <seconds>] [--last <number>] [--file]
+
+        Shows the plugin's latest dealings with the services Bot as JSON
+        lines, optionally only those on <network>, of kind <event> (sent,
+        answered, retry, timeout, mode, invited, unexpected, or the kind of
+        notice), about <target>, or from the last <seconds> seconds.  Shows the
+        last <number> events, 10 by default; with --file, writes all of them
+        to a file in the data directory instead.
+        """
+        filters = {}
+        last = 10
+        toFile = False
+        for (option, arg) in optlist:
+            if option == 'since':
+                filters['since'] = time.time() - arg
+            elif option == 'last':
+                last = arg
+            elif option == 'file':
+                toFile = True
+            else:
+                filters[option] = arg
+        events = self._events.select(**filters)
+        if toFile:
+            filename = conf.supybot.directories.data.dirize(
+                'NetGamers.events.jsonl')
+            fd = utils.file.AtomicFile(filename)
+            count = 0
+            for event in events:
+                fd.write(json.dumps(event, sort_keys=True) + '\n')
+                count += 1
+            fd.close()
+            irc.reply('Wrote %s events to %s.' % (count, filename))
+            return
+        L = deque(events, maxlen=last)
+        if not L:
+            irc.reply('No events recorded.')
+        else:
+            irc.replies([json.dumps(event, sort_keys=True) for event in L])
+    events = wrap(events, [('checkCapability', 'admin'),
+                           getopts({'network': 'something',
+                                    'event': 'something',
+                                    'target': 'something',
+                                    'since': 'positiveInt',
+                                    'last': 'positiveInt',
+                                    'file': ''})])
+
     def regged(self, irc, msg, args):
         """takes no arguments
 
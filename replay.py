@@ -0,0 +1,251 @@
+###
+# Copyright (c) 2009, Morten Lied Johansen
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Replays a raw IRC log through the NetGamers plugin, offline.
+
+Each line of the log is a message as the server sent it (":prefix COMMAND
+args").  The plugin sees them one at a time on a fake connection, and
+everything it does is written out, one line each:
+
+    <line> > PRIVMSG P@cservice.netgamers.org :op #chan    (what it sent)
+    <line> = doChanservNotice unbanned #chan               (how it took a
+                                                            notice)
+
+where <line> is the line of the log that caused it.  The log is read as a
+stream, so logs of any size replay in constant memory; gzipped logs (ending
+in .gz) are read as they are.  Run it from the plugin's directory:
+
+    python replay.py traffic.log --save expected.txt
+    python replay.py traffic.log --expected expected.txt
+
+With --expected, the output is compared with an earlier one line by line, and
+the script exits with status 1 if they differ.
+"""
+
+import sys
+import gzip
+import optparse
+from itertools import izip_longest
+from timeit import default_timer as timer
+
+import supybot.conf as conf
+import supybot.irclib as irclib
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+
+import plugin
+from fakeirc import FakeIrc
+
+class ReplayIrc(FakeIrc):
+    """A FakeIrc that keeps its state the way Supybot's Irc does, and runs
+    what the plugin sends through its outFilter."""
+    def __init__(self, cb, network='NetGamers', nick='Bot'):
+        FakeIrc.__init__(self, network, nick, afterConnect=False)
+        self.cb = cb
+        self.state = irclib.IrcState()
+        self.state.supported['NETWORK'] = network
+
+    def isChannel(self, s):
+        # The same as Irc.isChannel, with the server's CHANTYPES.
+        kw = {}
+        if 'chantypes' in self.state.supported:
+            kw['chantypes'] = self.state.supported['chantypes']
+        return ircutils.isChannel(s, **kw)
+
+    def sendMsg(self, msg):
+        msg = self.cb.outFilter(self, msg)
+        if msg is not None:
+            self.sent.append(msg)
+    queueMsg = sendMsg
+
+    def feedMsg(self, msg):
+        if msg.command == '001':
+            self.nick = msg.args[0]
+        elif msg.command == 'NICK' and ircutils.strEqual(msg.nick, self.nick):
+            self.nick = msg.args[0]
+        elif msg.command in ('376', '422'):
+            self.afterConnect = True
+        self.state.addMsg(self, msg)
+        self.cb(self, msg)
+
+# The handlers whose decisions go in the output, in the order doNotice tries
+# them.
+decisions = ['doThrottledNotice', 'doChanservNotice', 'doNickservNotice']
+
+def record(cb, out):
+    """Wraps cb's notice handlers so their decisions are appended to out."""
+    for name in decisions:
+        def wrapper(irc, msg, notice, name=name, f=getattr(cb, name)):
+            handled = f(irc, msg, notice)
+            if handled:
+                out.append('= %s %s %s' % (name, notice.event,
+                                           notice.target or '-'))
+            elif name == decisions[-1]:
+                out.append('= unexpected %r' % msg.args[1])
+            return handled
+        setattr(cb, name, wrapper)
+
+def readLog(fd):
+    """Yields (line number, IrcMsg) for every message in fd, skipping blank
+    lines, comments (starting with #) and lines that aren't messages."""
+    for (i, line) in enumerate(fd):
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        try:
+            msg = ircmsgs.IrcMsg(line)
+        except Exception:
+            sys.stderr.write('Skipping line %s, not a message: %r\n' %
+                             (i + 1, line))
+            continue
+        yield (i + 1, msg)
+
+def replay(cb, irc, msgs):
+    """Feeds msgs, (line number, IrcMsg) pairs, to cb through irc and yields
+    a line of output for everything the plugin did."""
+    out = []
+    record(cb, out)
+    for (lineno, msg) in msgs:
+        irc.feedMsg(msg)
+        for line in out:
+            yield '%s %s' % (lineno, line)
+        del out[:]
+        for sent in irc.takeSent():
+            yield '%s > %s' % (lineno, str(sent).rstrip('\r\n'))
+
+def compare(lines, expected):
+    """Yields (output line number, line, expected line) for every line of
+    lines that differs from expected; either may be None past the end."""
+    for (i, (line, wanted)) in enumerate(izip_longest(lines, expected)):
+        if wanted is not None:
+            wanted = wanted.rstrip('\r\n')
+        if line != wanted:
+            yield (i + 1, line, wanted)
+
+settings = {'servicesRate': 1000000.0, 'servicesBurst': 1000000,
+            'channelMemory': 0, 'eventLogSize': 0}
+
+def configure(values):
+    """Sets the registry values the replay needs, plus values, and returns a
+    function that puts the old ones back."""
+    group = conf.supybot.plugins.NetGamers
+    values = dict(settings, **values)
+    old = dict([(name, group.get(name)()) for name in values])
+    for (name, value) in values.iteritems():
+        group.get(name).setValue(value)
+    def restore():
+        for (name, value) in old.iteritems():
+            group.get(name).setValue(value)
+    return restore
+
+def openLog(filename):
+    if filename == '-':
+        return sys.stdin
+    elif filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <log>')
+    parser.add_option('--network', default='NetGamers',
+                      help='network the log is from [default: %default]')
+    parser.add_option('--nick', default='Bot',
+                      help="the bot's nick until the log's 001 "
+                           '[default: %default]')
+    parser.add_option('--regged-nick', dest='reggedNick',
+                      help='registered nick to identify with')
+    parser.add_option('--password', help='password to identify with')
+    parser.add_option('--bot-nick', dest='botNick',
+                      help='nick of the services Bot')
+    parser.add_option('--expected', help='compare the output with this file')
+    parser.add_option('--save', help='write the output to this file')
+    parser.add_option('--max-diffs', dest='maxDiffs', type='int', default=10,
+                      help='differences to show at most [default: %default]')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Give exactly one log to replay.')
+    values = {'networks': set([options.network])}
+    for name in ('reggedNick', 'password', 'botNick'):
+        if getattr(options, name) is not None:
+            values[name] = getattr(options, name)
+    restore = configure(values)
+    cb = plugin.Class(None)
+    fd = openLog(args[0])
+    save = options.save and open(options.save, 'w')
+    expected = options.expected and open(options.expected)
+    counts = {'messages': 0, 'output': 0}
+    def counted(msgs):
+        for x in msgs:
+            counts['messages'] += 1
+            yield x
+    def saved(lines):
+        for line in lines:
+            counts['output'] += 1
+            if save:
+                save.write(line + '\n')
+            yield line
+    diffs = 0
+    start = timer()
+    try:
+        irc = ReplayIrc(cb, options.network, options.nick)
+        lines = saved(replay(cb, irc, counted(readLog(fd))))
+        if expected:
+            for (i, line, wanted) in compare(lines, expected):
+                diffs += 1
+                if diffs <= options.maxDiffs:
+                    sys.stdout.write('Output line %s:\n  expected: %s\n'
+                                     '  got:      %s\n' % (i, wanted, line))
+        else:
+            for line in lines:
+                if not save:
+                    sys.stdout.write(line + '\n')
+    finally:
+        elapsed = timer() - start
+        cb.die()
+        restore()
+        for f in (fd, save, expected):
+            if f and f is not sys.stdin:
+                f.close()
+    sys.stderr.write('%s messages in %.2fs (%.0f msgs/s), %s lines of '
+                     'output.\n' % (counts['messages'], elapsed,
+                                    counts['messages'] / (elapsed or 1),
+                                    counts['output']))
+    if diffs:
+        sys.stdout.write('%s lines differ from %s.\n' %
+                         (diffs, options.expected))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
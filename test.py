@@ -30,8 +30,717 @@
 
 from supybot.test import *
 
+import supybot.schedule as schedule
+
+import replay
+import benchmark
+from plugin import ServicesQueue
+import config
+from fakeirc import FakeIrc
+from fakeservices import FakeServices
+
 class NetGamersTestCase(PluginTestCase):
     plugins = ('NetGamers',)
+    config = {'supybot.protocols.irc.strictRfc': False}
+
+    def testBenchmark(self):
+        # Keeps the benchmark from rotting; the numbers are checked by
+        # running benchmark.py itself.
+        results = benchmark.run(500, scenarios=[(2, 5, 'services')])
+        result = results['2 networks, 5 channels, services']
+        self.assertEqual(sum([r[0] for r in result.values()]), 500)
+
+    def testServicesQueue(self):
+        queue = ServicesQueue(1.0, 2)
+        for s in ('voice #a', 'op #a', 'LOGIN Bot secret'):
+            queue.put(ircmsgs.privmsg('P', s))
+        self.assertEqual([queue.take().args[1] for i in range(2)],
+                         ['LOGIN Bot secret', 'op #a'])
+        # The burst is used up.
+        self.assertEqual(queue.take(), None)
+        self.assertEqual(len(queue), 1)
+        self.failUnless(0.9 < queue.wait() <= 1)
+
+    def testServicesQueueThrottle(self):
+        queue = ServicesQueue(1.0, 2)
+        queue.throttle()
+        self.assertEqual(queue.rate, 0.5)
+        queue.put(ircmsgs.privmsg('P', 'op #a'))
+        self.assertEqual(queue.take(), None)
+        self.failUnless(1.9 < queue.wait() <= 2)
+        for i in range(10):
+            queue.throttle()
+        self.assertEqual(queue.rate, 1.0 / 16)
+        queue.recover()
+        self.assertEqual(queue.rate, 1.25 / 16)
+        for i in range(20):
+            queue.recover()
+        self.assertEqual(queue.rate, 1.0)
+        # A new rate in the config starts over.
+        queue.throttle()
+        queue.configure(4.0, 2)
+        self.assertEqual(queue.rate, 4.0)
+
+    def testReplay(self):
+        log = [':server 001 Bot :Welcome',
+               ':server 376 Bot :End of MOTD.',
+               ':P!cservice@netgamers.org NOTICE Bot :Flood me will you? '
+               'I\'m not going to listen to you anymore.',
+               ':P!cservice@netgamers.org NOTICE Bot :Password accepted - '
+               'you are now recognized.']
+        restore = replay.configure({'reggedNick': 'Bot',
+                                    'password': 'secret',
+                                    'networks': set(['NetGamers'])})
+        try:
+            cb = replay.plugin.Class(None)
+            try:
+                irc = replay.ReplayIrc(cb)
+                lines = list(replay.replay(cb, irc, replay.readLog(log)))
+            finally:
+                cb.die()
+        finally:
+            restore()
+        self.assertEqual(lines,
+                         ['2 > PRIVMSG P@cservice.netgamers.org :LOGIN Bot '
+                          'secret',
+                          '3 = doThrottledNotice throttled -',
+                          '4 = doNickservNotice accepted -'])
+
+class NetGamersServicesTestCase(PluginTestCase):
+    plugins = ('NetGamers',)
+    config = {'supybot.protocols.irc.strictRfc': False,
+              'supybot.plugins.NetGamers.reggedNick': 'test',
+              'supybot.plugins.NetGamers.password': 'secret',
+              'supybot.plugins.NetGamers.op': True,
+              'supybot.plugins.NetGamers.networks': set(['test']),
+              'supybot.plugins.NetGamers.servicesRate': 10000.0,
+              'supybot.plugins.NetGamers.servicesBurst': 10000}
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.services = FakeServices({self.nick: 'secret'})
+        self.cb = self.irc.getCallback('NetGamers')
+
+    def connect(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='376',
+                                        args=(self.nick, 'End of MOTD.')))
+        return self.services.pump(self.irc)
+
+    def join(self, channel):
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='366',
+                                        args=(self.nick, channel,
+                                              'End of /NAMES list.')))
+
+    def testIdentify(self):
+        self.connect()
+        self.assertEqual(self.services.loggedIn, self.nick)
+        self.failUnless(self.cb._getState(self.irc).identified)
+
+    def testWrongPassword(self):
+        group = conf.supybot.plugins.NetGamers
+        group.noJoinsUntilIdentified.setValue(True)
+        try:
+            self.services.accounts[self.nick] = 'something else'
+            self.irc.queueMsg(ircmsgs.join('#held'))
+            self.failIf(self.services.pump(self.irc))
+            # Held JOINs go out once it's clear we won't be logging in.
+            self.assertEqual(self.connect(), [ircmsgs.join('#held')])
+            self.assertEqual(self.services.loggedIn, None)
+            self.failIf(self.cb._getState(self.irc).identified)
+            self.irc.queueMsg(ircmsgs.join('#later'))
+            self.assertEqual(self.services.pump(self.irc),
+                             [ircmsgs.join('#later')])
+        finally:
+            group.noJoinsUntilIdentified.setValue(False)
+
+    def testNoticeClassifier(self):
+        phrases = self.cb._registerNetwork(self.irc.network).phrases
+        phrases.accepted.setValue(['welcome back'])
+        try:
+            self.connect()
+            self.failIf(self.cb._getState(self.irc).identified)
+            events = self.cb._events.select(network=self.irc.network,
+                                            event='unexpected')
+            self.assertEqual(len(list(events)), 1)
+        finally:
+            phrases.accepted.setValue([])
+        # Throttled is tried first, but the channel's name isn't the Bot
+        # telling us to slow down.
+        self.cb._botCommand(self.irc, '#Flood', 'unban')
+        others = self.services.pump(self.irc)
+        self.assertEqual(others, [ircmsgs.join('#flood')])
+        [event] = self.cb._events.select(event='unbanned')
+        self.assertEqual(event['target'], '#flood')
+        self.assertEqual(self.cb._getState(self.irc).queue.rate, 10000.0)
+
+    def testStatePerNetwork(self):
+        networks = conf.supybot.plugins.NetGamers.networks
+        networks.setValue(set(['test', 'other']))
+        conf.registerNetwork('other')
+        other = irclib.Irc('other')
+        try:
+            while other.takeMsg():
+                pass
+            self.connect()
+            # Logging in fails on the other network, and its new connection
+            # doesn't touch this one's state.
+            services = FakeServices({self.nick: 'something else'})
+            other.feedMsg(ircmsgs.IrcMsg(command='001',
+                                         args=(self.nick, 'Welcome')))
+            other.feedMsg(ircmsgs.IrcMsg(command='376',
+                                         args=(self.nick, 'End of MOTD.')))
+            services.pump(other)
+            self.failUnless(self.cb._getState(self.irc).identified)
+            self.failIf(self.cb._getState(other).identified)
+            # The failure holds off RECOVER on that network only.
+            self.failUnless(self.cb._getState(other).sentGhost)
+            self.assertEqual(self.cb._getState(self.irc).sentGhost, None)
+        finally:
+            other._reallyDie()
+            networks.setValue(set(['test']))
+
+    def testOpAfterJoin(self):
+        self.connect()
+        self.join('#test')
+        self.services.pump(self.irc)
+        self.failUnless(self.nick in self.irc.state.channels['#test'].ops)
+
+    def testHeldJoinsPacked(self):
+        group = conf.supybot.plugins.NetGamers
+        group.noJoinsUntilIdentified.setValue(True)
+        try:
+            # Eleven of these make a JOIN of exactly 513 bytes.
+            channels = ['#%02d%s' % (i, 'x' * 42) for i in range(100)]
+            for channel in channels:
+                self.irc.queueMsg(ircmsgs.join(channel))
+            self.irc.queueMsg(ircmsgs.join('#keyed', 'key'))
+            self.irc.queueMsg(ircmsgs.join(channels[0]))
+            self.failIf(self.services.pump(self.irc))
+            # A +r channel refused before we thought to hold it.
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='515',
+                                            args=(self.nick, '#registered',
+                                                  'Cannot join channel')))
+            joins = [m for m in self.connect() if m.command == 'JOIN']
+            # A line over the limit is cut short when it's sent.
+            for msg in joins:
+                self.assertEqual(ircmsgs.IrcMsg(str(msg)).args, msg.args)
+            self.assertEqual(joins[0].args[1], 'key')
+            joined = []
+            for msg in joins:
+                joined.extend(msg.args[0].split(','))
+            self.assertEqual(joined[0], '#keyed')
+            self.assertEqual(sorted(joined),
+                             sorted(channels + ['#keyed', '#registered']))
+            self.assertEqual(len(joins), 10)
+        finally:
+            group.noJoinsUntilIdentified.setValue(False)
+
+    def testOpOnIdentify(self):
+        self.join('#test')
+        self.services.pump(self.irc)
+        self.failIf(self.services.received)
+        self.connect()
+        self.failUnless(self.nick in self.irc.state.channels['#test'].ops)
+        self.assertEqual(self.cb._getState(self.irc).deficits,
+                         ircutils.IrcDict())
+
+    def testReopAfterBatchedDeop(self):
+        # Which modes 004 lists says nothing of which take arguments.
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='004',
+                                        args=(self.nick, 'server', 'version',
+                                              'iow', 'biklmnopstv')))
+        self.connect()
+        self.join('#test')
+        self.services.pump(self.irc)
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='someone!u@h', command='MODE',
+                                        args=('#test', '+mv-o', 'someone',
+                                              self.nick)))
+        self.failIf(self.nick in self.irc.state.channels['#test'].ops)
+        self.services.pump(self.irc)
+        self.failUnless(self.nick in self.irc.state.channels['#test'].ops)
+
+    def testJoinsKeepSettings(self):
+        self.connect()
+        generation = config.generation
+        for i in range(5):
+            self.join('#new%s' % i)
+        self.services.pump(self.irc)
+        self.assertEqual(config.generation, generation)
+        self.failUnless(self.cb._getState(self.irc).steady)
+        conf.supybot.plugins.NetGamers.op.get('#new0').setValue(False)
+        try:
+            self.assertEqual(config.generation, generation + 1)
+        finally:
+            conf.supybot.plugins.NetGamers.op.get('#new0').setValue(True)
+
+    def testDeficitsFollowChannelConfig(self):
+        self.services.access = set()
+        self.connect()
+        self.join('#test')
+        self.services.pump(self.irc)
+        state = self.cb._getState(self.irc)
+        self.assertEqual(self.cb._getDeficits(self.irc, state).keys(),
+                         ['#test'])
+        # A channel value made after the deficits were worked out.
+        op = conf.supybot.plugins.NetGamers.op.get('#test')
+        op.setValue(False)
+        try:
+            self.failIf(self.cb._getDeficits(self.irc, state))
+        finally:
+            op.setValue(True)
+        self.assertEqual(self.cb._getDeficits(self.irc, state).keys(),
+                         ['#test'])
+
+    def testBulkOp(self):
+        self.services.access = set(['#other'])
+        self.connect()
+        for channel in ('#team-a', '#team-b', '#other'):
+            self.join(channel)
+        self.services.pump(self.irc)
+        self.services.access = None
+        def op(s):
+            # The requests go straight out to the Bot, ahead of the reply, so
+            # the Bot has to be answered before the reply can be looked at.
+            self.irc.feedMsg(ircmsgs.privmsg(self.irc.nick, s,
+                                             prefix=self.prefix))
+            replies = [m.args[1] for m in self.services.pump(self.irc)
+                       if m.command in ('PRIVMSG', 'NOTICE')]
+            self.assertEqual(len(replies), 1)
+            return replies[0]
+        # Only a capability of the user's own will do for a glob, and the
+        # channels they lack it in aren't named.
+        reply = op('op #team-*')
+        self.failIf('#team' in reply, reply)
+        self.failIf(self.nick in self.irc.state.channels['#team-a'].ops)
+        user = ircdb.users.newUser()
+        user.name = 'tester'
+        user.addHostmask(self.prefix)
+        user.addCapability('#team-a,op')
+        ircdb.users.setUser(user)
+        reply = op('op #team-* #other')
+        self.failUnless(re.search('in #team-a;.* for 2 channels', reply))
+        user.addCapability('admin')
+        ircdb.users.setUser(user)
+        reply = op('op #team-* #other')
+        self.failUnless(re.search('in #team-b;.*already opped in '
+                                  '#team-a and #other', reply))
+        for channel in ('#team-a', '#team-b'):
+            self.failUnless(self.nick in self.irc.state.channels[channel].ops)
+        self.assertError('op *')
+
+    def testManyChannels(self):
+        self.connect()
+        channels = ['#test%s' % i for i in range(500)]
+        for channel in channels:
+            self.join(channel)
+        self.services.pump(self.irc)
+        for channel in channels:
+            self.failUnless(self.nick in self.irc.state.channels[channel].ops)
+
+    def testRepeatedNoticesCounted(self):
+        self.services.access = set()
+        self.connect()
+        for i in range(5):
+            self.join('#test%s' % i)
+        self.services.pump(self.irc)
+        repeats = self.cb._repeats.repeats
+        self.assertEqual(repeats[(self.irc.network, 'insufficientAccess')][1],
+                         4)
+        self.cb._repeats.flush()
+        self.failIf(repeats)
+
+    def testUnbanBeforeJoin(self):
+        self.connect()
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='474',
+                                        args=(self.nick, '#banned',
+                                              'Cannot join channel (+b)')))
+        self.services.pump(self.irc)
+        del self.services.received[:]
+        # Next time, we know to ask for the unban first.
+        self.irc.queueMsg(ircmsgs.join('#banned'))
+        others = self.services.pump(self.irc)
+        self.assertEqual(self.services.received, ['unban #banned %s' %
+                                                  self.nick])
+        self.assertEqual([m.args[0] for m in others if m.command == 'JOIN'],
+                         ['#banned'])
+
+    def testJoinWhenUnbanRefused(self):
+        self.connect()
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='474',
+                                        args=(self.nick, '#banned',
+                                              'Cannot join channel (+b)')))
+        self.services.pump(self.irc)
+        del self.services.received[:]
+        self.services.access = set()
+        self.irc.queueMsg(ircmsgs.join('#banned', 'key'))
+        others = self.services.pump(self.irc)
+        self.assertEqual(self.services.received, ['unban #banned %s' %
+                                                  self.nick])
+        self.assertEqual([m.args for m in others if m.command == 'JOIN'],
+                         [('#banned', 'key')])
+
+    def testJoinForgetsNeeds(self):
+        self.connect()
+        for (numeric, channel) in [('473', '#invite'), ('475', '#key')]:
+            self.irc.feedMsg(ircmsgs.IrcMsg(command=numeric,
+                                            args=(self.nick, channel,
+                                                  'Cannot join channel')))
+        self.services.pump(self.irc)
+        needs = self.cb._knowledge.needs
+        self.assertEqual(needs(self.irc.network, '#invite', 60),
+                         set(['invite']))
+        self.failIf(needs(self.irc.network, '#key', 60))
+        # The Bot got us in, so we'll need it next time too.
+        self.join('#invite')
+        self.assertEqual(needs(self.irc.network, '#invite', 60),
+                         set(['invite']))
+        self.cb._knowledge.learn(self.irc.network, '#test', 'unban')
+        self.join('#test')
+        self.failIf(needs(self.irc.network, '#test', 60))
+
+    def testUnansweredUnbanNotRepeated(self):
+        self.connect()
+        del self.services.received[:]
+        self.services.dropRate = 1
+        for i in range(5):
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='474',
+                                            args=(self.nick, '#banned',
+                                                  'Cannot join channel (+b)')))
+        self.services.pump(self.irc)
+        self.assertEqual(self.services.received, ['unban #banned %s' %
+                                                  self.nick])
+
+    def testThrottled(self):
+        self.services.rate = 0.001
+        self.services.burst = 1
+        self.services.tokens = 1
+        self.connect()
+        self.join('#test')
+        self.services.pump(self.irc)
+        queue = self.cb._getState(self.irc).queue
+        self.assertEqual(queue.rate, 5000.0)
+        self.failIf(self.nick in self.irc.state.channels['#test'].ops)
+
+    def testLatency(self):
+        self.services.latency = 0.1
+        self.connect()
+        stats = self.cb._latencies[self.irc.network]['LOGIN']
+        self.assertEqual(stats.calls, 1)
+        self.failUnless(stats.total >= 0.1)
+        self.failIf(self.cb._getState(self.irc).requests)
+
+    def testStartup(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='001',
+                                        args=(self.nick, 'Welcome')))
+        self.irc.queueMsg(ircmsgs.join('#test'))
+        self.connect()
+        self.join('#test')
+        self.services.pump(self.irc)
+        phases = self.cb._startup[self.irc.network]
+        for phase in ('motd', 'login', 'identified', 'names', 'op', 'total'):
+            self.assertEqual(len(phases[phase]), 1)
+        self.assertNotError('startup')
+
+    def sent(self):
+        """Returns what's been sent since the last call."""
+        msgs = []
+        msg = self.irc.takeMsg()
+        while msg is not None:
+            msgs.append(msg)
+            msg = self.irc.takeMsg()
+        return msgs
+
+    def register(self, preLogin):
+        """Sends what registers us with the server with preLogin set, and
+        returns what went out."""
+        conf.supybot.plugins.NetGamers.preLogin.setValue(preLogin)
+        self.irc.queueMsg(ircmsgs.nick(self.nick))
+        self.irc.queueMsg(ircmsgs.user('user', 'test'))
+        return self.sent()
+
+    def sasl(self, command, *args):
+        """Feeds the server's answer to SASL, and returns what we sent back,
+        minus the CAP END Limnoria sends on its own."""
+        self.irc.feedMsg(ircmsgs.IrcMsg(command=command, args=args))
+        return [m for m in self.sent() if m.command != 'CAP']
+
+    capEnd = ircmsgs.IrcMsg(command='CAP', args=('END',))
+
+    def coreSasl(self):
+        """Skips the test if the bot does SASL itself, as Limnoria does."""
+        if hasattr(self.irc, 'sasl_authenticated'):
+            self.skipTest('SASL is left to Limnoria.')
+
+    def testSaslLeftToCore(self):
+        if not hasattr(self.irc, 'sasl_authenticated'):
+            self.skipTest('This bot has no SASL of its own.')
+        try:
+            msgs = self.register('sasl')
+            self.failIf([m for m in msgs if m.command == 'CAP'])
+            self.assertEqual(self.cb._getState(self.irc).preLogin, 'failed')
+            self.connect()
+            self.assertEqual(self.services.loggedIn, self.nick)
+        finally:
+            conf.supybot.plugins.NetGamers.preLogin.setValue('off')
+
+    def testSasl(self):
+        self.coreSasl()
+        try:
+            msgs = self.register('sasl')
+            self.failUnless(ircmsgs.IrcMsg(command='CAP',
+                                           args=('REQ', 'sasl')) in msgs)
+            self.assertEqual([m.args for m in
+                              self.sasl('CAP', '*', 'ACK', 'sasl')],
+                             [('PLAIN',)])
+            [msg] = self.sasl('AUTHENTICATE', '+')
+            self.assertEqual(msg.args[0].decode('base64'),
+                             'test\0test\0secret')
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='903',
+                                            args=(self.nick, 'Success')))
+            self.failUnless(self.capEnd in self.sent())
+            self.failUnless(self.cb._getState(self.irc).identified)
+            self.connect()
+            self.failIf(self.services.received)
+        finally:
+            conf.supybot.plugins.NetGamers.preLogin.setValue('off')
+
+    def testSaslUnanswered(self):
+        self.coreSasl()
+        try:
+            self.register('sasl')
+            self.sasl('CAP', '*', 'ACK', 'sasl')
+            schedule.rescheduleEvent('NetGamers.sasl.%s' % self.irc.network,
+                                     0)
+            schedule.run()
+            self.failUnless(self.capEnd in self.sent())
+            self.assertEqual(self.cb._getState(self.irc).preLogin, 'failed')
+            self.connect()
+            self.assertEqual(self.services.loggedIn, self.nick)
+        finally:
+            conf.supybot.plugins.NetGamers.preLogin.setValue('off')
+
+    def testSaslRefused(self):
+        self.coreSasl()
+        try:
+            self.register('sasl')
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='CAP',
+                                            args=('*', 'NAK', 'sasl')))
+            self.failUnless(self.capEnd in self.sent())
+            self.failIf(schedule.schedule.events.get('NetGamers.sasl.%s' %
+                                                     self.irc.network))
+            self.connect()
+            self.assertEqual(self.services.loggedIn, self.nick)
+        finally:
+            conf.supybot.plugins.NetGamers.preLogin.setValue('off')
+
+    def testPass(self):
+        try:
+            msgs = self.register('pass')
+            self.failUnless(ircmsgs.password('test:secret') in msgs)
+            self.irc.feedMsg(ircmsgs.notice(self.nick, 'Password accepted - '
+                                            'you are now recognized.',
+                                            prefix=self.services.prefix))
+            self.failUnless(self.cb._getState(self.irc).identified)
+            self.connect()
+            self.failIf(self.services.received)
+        finally:
+            conf.supybot.plugins.NetGamers.preLogin.setValue('off')
+
+    def testStats(self):
+        self.assertError('stats')
+        conf.supybot.plugins.NetGamers.collectStats.setValue(True)
+        try:
+            self.connect()
+            self.cb._stats.count('other', 'unexpected notices')
+            self.assertRegexp('stats', 'doNotice: 1 calls')
+            self.assertRegexp('stats', r'_getDeficits: \d+ calls')
+            self.assertNotError('stats --reset')
+            # Only the stats commands themselves since.
+            self.assertNotRegexp('stats', 'doNotice')
+            # Other networks keep counting.
+            self.assertRegexp('stats other', 'unexpected notices: 1')
+        finally:
+            conf.supybot.plugins.NetGamers.collectStats.setValue(False)
+
+    def testReloadKeepsState(self):
+        self.irc.feedMsg(ircmsgs.IrcMsg(command='001',
+                                        args=(self.nick, 'Welcome')))
+        self.connect()
+        # What Owner's reload does.
+        self.irc.removeCallback(self.cb.name())
+        self.cb.die()
+        cb = self.cb.__class__(self.irc)
+        self.irc.addCallback(cb)
+        self.failUnless(cb._getState(self.irc).identified)
+        self.assertEqual(self.irc.takeMsg(), None)
+        self.cb.die()
+        self.failUnless(cb._getState(self.irc).identified)
+
+    def testInviteFromImpostor(self):
+        group = conf.supybot.plugins.NetGamers
+        group.verifyBotHost.setValue(True)
+        group.botHost.setValue('cservice@netgamers.org')
+        try:
+            self.connect()
+            self.irc.feedMsg(ircmsgs.IrcMsg(prefix='P!evil@example.com',
+                                            command='INVITE',
+                                            args=(self.nick, '#trap')))
+            self.assertEqual(self.irc.takeMsg(), None)
+            # P's messages don't come from the host in botNick, so with no
+            # botHost nothing is trusted rather than guessing.
+            group.botHost.setValue('')
+            prefix = 'P!x@cservice.netgamers.org'
+            self.irc.feedMsg(ircmsgs.IrcMsg(prefix=prefix, command='INVITE',
+                                            args=(self.nick, '#trap')))
+            self.assertEqual(self.irc.takeMsg(), None)
+        finally:
+            group.verifyBotHost.setValue(False)
+            group.botHost.setValue('')
+
+    def testMonitorReclaims(self):
+        group = conf.supybot.plugins.NetGamers
+        group.reggedNick.setValue('owned')
+        group.useRegged.setValue(True)
+        self.irc.state.supported['MONITOR'] = '100'
+        try:
+            others = self.connect()
+            self.assertEqual([m.args for m in others], [('+', 'owned')])
+            # Nobody we share a channel with has the nick; the server tells
+            # us it's free.
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='731',
+                                            args=(self.nick, 'owned')))
+            self.assertEqual(self.irc.takeMsg(), ircmsgs.nick('owned'))
+        finally:
+            del self.irc.state.supported['MONITOR']
+            group.useRegged.setValue(False)
+            group.reggedNick.setValue('test')
+
+    def reclaimTime(self):
+        name = 'NetGamers.reclaim.%s' % self.irc.network
+        [when] = [e[0] for e in schedule.schedule.schedule if e[1] == name]
+        return when - time.time()
+
+    def testReclaimCheckSkipped(self):
+        self.connect()
+        calls = []
+        reclaim = self.cb._reclaim
+        self.cb._reclaim = lambda irc: calls.append(irc.network) or \
+                                       reclaim(irc)
+        group = conf.supybot.plugins.NetGamers
+        try:
+            # Identified on the nick we want: nothing to check.
+            self.failUnless(self.cb._getState(self.irc).steady)
+            self.irc.feedMsg(ircmsgs.ping('server'))
+            self.assertEqual(calls, [])
+            group.reggedNick.setValue('owned')
+            group.useRegged.setValue(True)
+            # Watching the nick with ISON, only PING is left to check on.
+            self.irc.feedMsg(ircmsgs.privmsg('#test', 'hi',
+                                             prefix='someone!u@h'))
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='NICK', args=('other',),
+                                            prefix='someone!u@h'))
+            self.assertEqual(calls, [])
+            self.irc.feedMsg(ircmsgs.ping('server'))
+            self.assertEqual(calls, [self.irc.network])
+        finally:
+            del self.cb._reclaim
+            group.useRegged.setValue(False)
+            group.reggedNick.setValue('test')
+
+    def testReclaimNickInUse(self):
+        group = conf.supybot.plugins.NetGamers
+        group.reggedNick.setValue('owned')
+        group.useRegged.setValue(True)
+        self.services.accounts['owned'] = 'secret'
+        self.services.holders['owned'] = 'owned!ghost@example.com'
+        try:
+            self.assertEqual(self.connect(),
+                             [ircmsgs.IrcMsg(command='ISON', args=('owned',))])
+            # ISON says nobody has it, but somebody takes it first.
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='303', args=(self.nick,
+                                                                 '')))
+            self.assertEqual(self.irc.takeMsg(), ircmsgs.nick('owned'))
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='433',
+                                            args=(self.nick, 'owned',
+                                                  'Nickname is already in '
+                                                  'use.')))
+            others = self.services.pump(self.irc)
+            self.assertEqual(self.services.received,
+                             ['RECOVER owned owned secret'])
+            self.assertEqual(others, [ircmsgs.nick('owned')])
+            self.irc.feedMsg(ircmsgs.nick('owned', prefix=self.prefix))
+            self.services.pump(self.irc)
+            state = self.cb._getState(self.irc)
+            self.assertEqual((state.reclaim, state.attempts), ('idle', 0))
+            self.assertEqual(self.services.loggedIn, 'owned')
+        finally:
+            group.useRegged.setValue(False)
+            group.reggedNick.setValue('test')
+
+    def testReclaimRecoverFails(self):
+        group = conf.supybot.plugins.NetGamers
+        group.reggedNick.setValue('owned')
+        group.useRegged.setValue(True)
+        self.services.accounts['owned'] = 'something else'
+        self.services.holders['owned'] = 'owned!ghost@example.com'
+        delay = group.ghostDelay()
+        try:
+            self.connect()
+            self.irc.feedMsg(ircmsgs.IrcMsg(command='303', args=(self.nick,
+                                                                 'owned')))
+            self.services.pump(self.irc)
+            self.assertEqual(self.services.received,
+                             ['RECOVER owned owned secret'])
+            state = self.cb._getState(self.irc)
+            self.assertEqual((state.reclaim, state.attempts), ('waiting', 1))
+            self.failUnless(delay <= self.reclaimTime() <= delay * 1.25)
+            # Trying again too soon sends nothing, and backs off further.
+            schedule.rescheduleEvent('NetGamers.reclaim.%s' %
+                                     self.irc.network, 0)
+            schedule.run()
+            self.services.pump(self.irc)
+            self.assertEqual(len(self.services.received), 1)
+            self.assertEqual((state.reclaim, state.attempts), ('waiting', 2))
+            self.failUnless(delay * 2 <= self.reclaimTime() <= delay * 2.5)
+        finally:
+            group.useRegged.setValue(False)
+            group.reggedNick.setValue('test')
+
+    def testEvents(self):
+        self.connect()
+        events = list(self.cb._events.select(network=self.irc.network))
+        self.assertEqual([e['event'] for e in events],
+                         ['sent', 'accepted', 'answered'])
+        self.assertEqual(events[0]['detail'], 'LOGIN')
+        self.assertNotError('events --event accepted')
+
+    def testNoGroupForDisabledNetwork(self):
+        irc = FakeIrc(network='Elsewhere', nick=self.nick)
+        self.cb(irc, ircmsgs.IrcMsg(command='376',
+                                    args=(self.nick, 'End of MOTD.')))
+        self.failIf(irc.takeSent())
+        self.assertRaises(registry.NonExistentRegistryEntry,
+                          conf.supybot.plugins.NetGamers.get, 'Elsewhere')
+        # Enabled by the name its server announces.
+        irc.state.supported['NETWORK'] = 'test'
+        self.cb(irc, ircmsgs.IrcMsg(command='005',
+                                    args=(self.nick, 'NETWORK=test',
+                                          'are supported')))
+        self.failUnless(self.cb._isEnabled(irc))
+        conf.supybot.plugins.NetGamers.get('Elsewhere')
+
+    def testRegister(self):
+        group = conf.supybot.plugins.NetGamers
+        group.networks.setValue(set())
+        try:
+            self.assertNotError('register Q@CServe.example.org other secret2')
+            self.failUnless(self.irc.network in group.networks())
+            self.assertResponse('regged', 'other')
+        finally:
+            group.networks.setValue(set([self.irc.network]))
+            for name in ('botNick', 'reggedNick', 'password'):
+                group.get(self.irc.network).get(name).setValue('')
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: